@@ -1,2 +1,8 @@
-from task_board import TaskBoardMacro
-from burn_down_table import BurnDownTableMacro
+from task_board import TaskBoardMacro, TaskBoardUpdateHandler
+from burn_down_table import BurnDownTableMacro, BurnDownDataHandler
+from iteration_overview import IterationOverviewMacro
+from history_cache import TicketHistoryCache
+from admin import TicketHistoryAdmin
+from worker_pool import HistoryWorkerPool
+from snapshots import TicketSnapshots
+from business_calendar import BusinessCalendarSettings
@@ -0,0 +1,89 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import re
+
+from trac.core import Component, implements
+from trac.admin.api import IAdminCommandProvider
+from trac.db.api import DatabaseManager
+from trac.db.schema import Table, Column, Index
+from trac.util.text import printout
+from tickethistory.snapshots import TicketSnapshots
+
+
+# The indexes that support the lookup of the tickets that were at any time
+# part of a milestone (see dbutils._milestone_ticket_ids_sql).
+ticket_change_indexes = Table('ticket_change', key=('ticket', 'time', 'field'))[
+        Column('ticket', type='int'),
+        Column('time', type='int64'),
+        Column('author'),
+        Column('field'),
+        Column('oldvalue'),
+        Column('newvalue'),
+        Index(['field', 'newvalue']),
+        Index(['field', 'oldvalue'])]
+
+# The index that supports the lookup of the tickets changed after a time
+# (see task_board.TaskBoardUpdateHandler).
+ticket_indexes = Table('ticket', key='id')[
+        Column('id', auto_increment=True),
+        Column('changetime', type='int64'),
+        Index(['changetime'])]
+
+
+_rxcreateindex = re.compile( r'^\s*CREATE\s+(UNIQUE\s+)?INDEX\b', re.IGNORECASE )
+
+# Generate only the CREATE INDEX statements for the @p table with the
+# connector of the environment's database.
+def index_statements( env, table ):
+    connector, _ = DatabaseManager(env).get_connector()
+    return [ sql for sql in connector.to_sql( table ) if _rxcreateindex.match( sql ) ]
+
+
+def create_indexes( env, table ):
+    created = []
+    for sql in index_statements( env, table ):
+        try:
+            with env.db_transaction as db:
+                db( sql )
+            created.append( sql )
+        except Exception as e:
+            env.log.info( "Index not created: %s (%s)", sql, e )
+    return created
+
+
+class TicketHistoryAdmin(Component):
+    """
+    trac-admin commands of the TicketHistory plugin.
+    """
+    implements(IAdminCommandProvider)
+
+    def get_admin_commands(self):
+        yield ('tickethistory index', '',
+               """Create the indexes on ticket_change and ticket that speed
+               up the lookup of the tickets in a milestone and of the
+               recently changed tickets.
+
+               The indexes are optional.  The statements for the existing
+               indexes fail and are skipped.""",
+               None, self._do_index)
+        yield ('tickethistory snapshot', '',
+               """Create the table of the daily ticket snapshots if needed
+               and rebuild the snapshots from the ticket history.
+
+               The burn-down tables use the snapshots after they are
+               rebuilt.  Run the command again when the estimation field
+               or the timezone of the server changes.""",
+               None, self._do_snapshot)
+
+    def _do_index(self):
+        created = create_indexes( self.env, ticket_change_indexes )
+        created += create_indexes( self.env, ticket_indexes )
+        for sql in created:
+            printout( sql )
+        printout( "%d indexes created." % len(created) )
+
+    def _do_snapshot(self):
+        count = TicketSnapshots(self.env).backfill()
+        printout( "%d snapshots created." % count )
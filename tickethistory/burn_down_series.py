@@ -0,0 +1,221 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import math
+
+from tickethistory import workdays
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Status categories of the tickets in the aggregation matrices.
+ABSENT, NEW, WIP, DONE = -1, 0, 1, 2
+
+# The decimals of the sums.  The NumPy and the Python sums differ in the last
+# bits; the rounded sums are equal, eg. when they are displayed with one
+# decimal.
+SUM_DECIMALS = 9
+
+
+class DayTotals:
+    """
+    The sums of the estimates of the tickets in a timetable entry.
+    """
+    def __init__(self, endtime, total, new, wip, done):
+        self.endtime = endtime
+        self.total = total
+        self.new = new
+        self.wip = wip
+        self.done = done
+        self.remaining = total - done
+        # Set by BurnDownSeries
+        self.end = None # projected end date
+        self.endWorkdays = None # projected end date, only workdays are counted
+        self.delay = None # days between endWorkdays and the end of the iteration
+
+
+class BurnDownSeries:
+    """
+    The per-day totals of an iteration together with the projected end dates
+    and delays.  The series is calculated once and shared by the renderers.
+
+    The projected end dates of all the days are calculated in one batch.  The
+    workdays are defined by the workdays.BusinessCalendar @p calendar.
+    """
+    def __init__(self, dayTotals, starttime, endtime, calendar=None):
+        if calendar is None:
+            calendar = workdays.BusinessCalendar( first=starttime.date(), last=endtime.date() )
+        self.starttime = starttime
+        self.endtime = endtime
+        self.calendar = calendar
+        self.days = dayTotals
+        self.entries = None # optional source TimetableEntry list, for debugging
+        self.minDelay = None
+        self.maxDelay = None
+
+        for day in self.days:
+            day.end = workdays.estimate_end( self.starttime, day.endtime, day.total, day.remaining )
+        self._estimateEndWorkdays( calendar )
+
+
+    # Estimate the end dates on the workdays.
+    def _estimateEndWorkdays(self, calendar):
+        isWorkday = calendar.is_busday_batch( [ day.endtime.date() for day in self.days ] )
+        days = [ day for day, work in zip( self.days, isWorkday ) if work ]
+        if len(days) == 0:
+            return
+        ends = workdays.estimate_end_workdays_batch( self.starttime, [ day.endtime for day in days ],
+                [ day.total for day in days ], [ day.remaining for day in days ], calendar=calendar )
+        for day, end in zip( days, ends ):
+            day.endWorkdays = end
+            if end is None:
+                continue
+            day.delay = ( end.date() - self.endtime.date() ).days
+            if self.minDelay is None or day.delay < self.minDelay:
+                self.minDelay = day.delay
+            if self.maxDelay is None or day.delay > self.maxDelay:
+                self.maxDelay = day.delay
+
+
+    @staticmethod
+    def fromEntries(timeTableConfig, entries, starttime, endtime, calendar=None):
+        dayTotals = BurnDownAggregator( timeTableConfig ).aggregate( entries )
+        return BurnDownSeries( dayTotals, starttime, endtime, calendar )
+
+
+    # Generate the DayTotals of the entries with the projected end dates one
+    # day at a time, as soon as an entry is generated.  The values are the
+    # same as in the series built by fromEntries(), but the end dates are not
+    # calculated in a batch and minDelay/maxDelay are not available.
+    @staticmethod
+    def iterDays(timeTableConfig, entries, starttime, endtime, calendar=None):
+        if calendar is None:
+            calendar = workdays.BusinessCalendar( first=starttime.date(), last=endtime.date() )
+        for day in BurnDownAggregator( timeTableConfig ).iterate( entries ):
+            day.end = workdays.estimate_end( starttime, day.endtime, day.total, day.remaining )
+            if calendar.is_busday( day.endtime.date() ):
+                day.endWorkdays = workdays.estimate_end_workdays( starttime, day.endtime,
+                        day.total, day.remaining, calendar=calendar )
+                if day.endWorkdays is not None:
+                    day.delay = ( day.endWorkdays.date() - endtime.date() ).days
+            yield day
+
+
+class BurnDownAggregator:
+    """
+    Sum the estimates of the tickets in the timetable entries by the status
+    category.
+
+    Every TicketInfo is evaluated only once even if it is shared between
+    several entries.  aggregate() builds the (days x tickets) estimate and
+    status-category matrices of all the entries and sums them per day with
+    NumPy when it is available.  iterate() keeps only the sums of every
+    entry and is used with the streamed entries.
+    """
+    def __init__(self, timeTableConfig, useNumpy=None):
+        self.tt_config = timeTableConfig
+        self.useNumpy = ( numpy is not None ) if useNumpy is None else ( useNumpy and numpy is not None )
+
+
+    def estimate(self, tinfo, default=1):
+        v = tinfo.value_or( self.tt_config.estimation_field, default )
+        try: return max(float(v), self.tt_config.min_estimation) if v is not None else default
+        except: return default
+
+
+    def category(self, tinfo):
+        if tinfo.status in self.tt_config.closed_states:
+            return DONE
+        if tinfo.status in self.tt_config.new_states:
+            return NEW
+        return WIP
+
+
+    # Evaluate the tickets in the entries.  Generates ( endtime, cells ) for
+    # every entry where cells is a list of ( column, estimate, category ).
+    # Every distinct ticket gets its own column.  The entries are consumed one
+    # at a time and a TicketInfo that is shared with the previous entry is not
+    # evaluated again.
+    def _evaluate(self, entries):
+        columns = {} # tid -> column index
+        evaluated = {} # tid -> ( TicketInfo, ( column, estimate, category ) )
+        for entry in entries:
+            row = []
+            for t in entry.tickets:
+                tid = t.tid()
+                prev = evaluated.get( tid )
+                if prev is None or prev[0] is not t:
+                    column = columns.setdefault( tid, len(columns) )
+                    prev = evaluated[tid] = ( t, ( column, self.estimate( t ), self.category( t ) ) )
+                row.append( prev[1] )
+            yield entry.endtime, row
+
+
+    # Build the (days x tickets) estimate and category matrices with NumPy.
+    # The tickets that are not in an entry are ABSENT.
+    def buildMatrices(self, entries):
+        cells = [ row for _, row in self._evaluate( entries ) ]
+        return self._matrices( cells, self._width( cells ) )
+
+
+    @staticmethod
+    def _width( cells ):
+        return 1 + max( [ -1 ] + [ c for row in cells for c, _, _ in row ] )
+
+
+    @staticmethod
+    def _matrices( cells, width ):
+        est = numpy.zeros( ( len(cells), width ), dtype=numpy.float64 )
+        cat = numpy.full( ( len(cells), width ), ABSENT, dtype=numpy.int8 )
+        for day, row in enumerate( cells ):
+            if len(row) > 0:
+                columns, estimates, categories = zip( *row )
+                est[day, list(columns)] = estimates
+                cat[day, list(columns)] = categories
+        return est, cat
+
+
+    # Sum all the entries at once; the matrices are summed with NumPy when
+    # it is available.
+    def aggregate(self, entries):
+        evaluated = list( self._evaluate( entries ) )
+        if len(evaluated) == 0:
+            return []
+        cells = [ row for _, row in evaluated ]
+        if self.useNumpy:
+            sums = self._sumMatrices( *self._matrices( cells, self._width( cells ) ) )
+        else:
+            sums = [ self._sumRow( row ) for row in cells ]
+        return [ DayTotals( endtime, *rowSums ) for ( endtime, _ ), rowSums in zip( evaluated, sums ) ]
+
+
+    # Generate the DayTotals of the entries one at a time.  The entries may be
+    # generated lazily (see HistoryBuilder.iterTimetableEntries); only the
+    # sums of an entry are kept after it is evaluated.  A NumPy sum is slower
+    # on single rows because the arrays have to be created for every row.
+    def iterate(self, entries):
+        for endtime, row in self._evaluate( entries ):
+            yield DayTotals( endtime, *self._sumRow( row ) )
+
+
+    # The sums of the estimates in a row: ( total, new, wip, done ).
+    @staticmethod
+    def _sumRow( row ):
+        bycat = { NEW: [], WIP: [], DONE: [] }
+        for _, e, c in row:
+            bycat[c].append( e )
+        return tuple( round( math.fsum( values ), SUM_DECIMALS ) for values in
+                ( [ e for _, e, _ in row ], bycat[NEW], bycat[WIP], bycat[DONE] ) )
+
+
+    # The per-day sums of the matrices: [ ( total, new, wip, done ) ].
+    @staticmethod
+    def _sumMatrices( est, cat ):
+        new = numpy.where( cat == NEW, est, 0.0 ).sum( axis=1 )
+        wip = numpy.where( cat == WIP, est, 0.0 ).sum( axis=1 )
+        done = numpy.where( cat == DONE, est, 0.0 ).sum( axis=1 )
+        total = est.sum( axis=1 )
+        return zip( *[ numpy.round( sums, SUM_DECIMALS ).tolist() for sums in ( total, new, wip, done ) ] )
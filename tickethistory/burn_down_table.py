@@ -3,6 +3,9 @@
 ## Licensed under the MIT License. See LICENSE file in the project root for full license information.
 
 import time
+import csv
+import email.utils
+import json
 import StringIO
 import math
 import traceback
@@ -11,16 +14,17 @@ import datetime as dt
 from trac.wiki import Formatter
 from trac.wiki.macros import WikiMacroBase
 from trac.wiki.api import parse_args
-from trac.util.datefmt import from_utimestamp as from_timestamp, to_datetime, to_utimestamp as to_timestamp
-from trac.core import implements, TracError
+from trac.util.datefmt import from_utimestamp as from_timestamp, to_datetime, to_utimestamp as to_timestamp, http_date
+from trac.core import Component, implements, TracError
+from trac.web.api import IRequestHandler, HTTPBadRequest, RequestDone
 from trac.web.chrome import ITemplateProvider, Chrome, add_stylesheet, add_script, add_script_data
-from tickethistory import options, dbutils, workdays, ticket_timetable as history
+from tickethistory import options, dbutils, history_cache, render_cache, worker_pool, snapshots, business_calendar, burn_down_series, stage_stats, ticket_timetable as history
 from genshi.core import Markup
 
 
 class BurnDownTableOptions(options.OptionRegistry):
     def __init__(self):
-        super(BurnDownTableOptions, self).__init__(["startdate", "enddate", "today"])
+        super(BurnDownTableOptions, self).__init__(["startdate", "enddate", "today", "debug"])
         self._overrides = None
 
 
@@ -60,11 +64,11 @@ class BurnDownTableGraphColumn:
     of completed work is behind schedule and the green bar is shown if the work
     is ahead of schedule.
     """
-    def __init__(self, timeTableConfig, timeTable, milestoneStart, milestoneEnd ):
+    def __init__(self, timeTableConfig, series ):
         self.tt_config = timeTableConfig
-        self.timetable = timeTable
-        self.starttime = milestoneStart
-        self.endtime = milestoneEnd
+        self.series = series
+        self.starttime = series.starttime
+        self.endtime = series.endtime
         # graphs after this date have the style cg-future
         self.futureDate = (dt.datetime.today() + dt.timedelta(days=1)).date()
         self._updateMinMaxEstimatedDelay()
@@ -73,29 +77,8 @@ class BurnDownTableGraphColumn:
     # Calculate the limits for the "graph": the min and max projected delay.
     # Negative values mean that some work was done ahead of time.
     def _updateMinMaxEstimatedDelay(self, low=-8, high=+22):
-        self.minDelay = 0
-        self.maxDelay = 0
-
-        def estimate(tinfo, default=1):
-            v = tinfo.value_or( self.tt_config.estimation_field, default )
-            try: return max(float(v), self.tt_config.min_estimation) if v is not None else default
-            except: return default
-
-        for entry in self.timetable.entries:
-            date = entry.endtime.date()
-            if date.weekday() > 4:
-                continue
-            pdone = sum( estimate(t) for t in entry.tickets if t.status in self.tt_config.closed_states )
-            ptotal = sum( estimate(t) for t in entry.tickets )
-            premaining = ptotal - pdone
-            enddate_wd = workdays.estimate_end_workdays( self.starttime, entry.endtime, ptotal, premaining )
-            if enddate_wd is None:
-                continue
-            delay = (enddate_wd.date() - self.endtime.date()).days
-            if delay < self.minDelay:
-                self.minDelay = delay
-            if delay > self.maxDelay:
-                self.maxDelay = delay
+        self.minDelay = min( 0, self.series.minDelay ) if self.series.minDelay is not None else 0
+        self.maxDelay = max( 0, self.series.maxDelay ) if self.series.maxDelay is not None else 0
         if self.minDelay < low:
             self.minDelay = low
         if self.minDelay > low / 2:
@@ -171,35 +154,19 @@ class HtmlBurnDownTableRenderer:
         return "".join( content )
 
 
-    def render(self, entries, starttime, today, formatter ):
+    def render(self, series, today, formatter ):
         add_stylesheet(formatter.req, 'tickethistory/css/burndowntable.css')
 
-        def estimate(tinfo, default=1):
-            v = tinfo.value_or( self.tt_config.estimation_field, default )
-            try: return max(float(v), self.tt_config.min_estimation) if v is not None else default
-            except: return default
-
-        for entry in entries:
-            date = entry.endtime.date()
-            pnew = sum( estimate(t) for t in entry.tickets if t.status in self.tt_config.new_states )
-            pdone = sum( estimate(t) for t in entry.tickets if t.status in self.tt_config.closed_states )
-            ptotal = sum( estimate(t) for t in entry.tickets )
-            pwip = ptotal - pnew - pdone
-            premaining = ptotal - pdone
-
-            enddate = workdays.estimate_end( starttime, entry.endtime, ptotal, premaining )
-            enddate = "" if enddate is None else enddate.date()
-            if date.weekday() > 4:
-                enddate_wd = ""
-            else:
-                enddate_wd = workdays.estimate_end_workdays( starttime, entry.endtime, ptotal, premaining )
-                enddate_wd = "" if enddate_wd is None else enddate_wd.date()
+        for day in series.days:
+            date = day.endtime.date()
+            enddate = "" if day.end is None else day.end.date()
+            enddate_wd = "" if day.endWorkdays is None else day.endWorkdays.date()
 
             if date == today: cssclass = "today"
-            elif date.weekday() > 4: cssclass = "weekend"
+            elif not series.calendar.is_busday( date ): cssclass = "weekend"
             else: cssclass = "normal"
 
-            self.addRow( cssclass, date, ptotal, premaining, pnew, pwip, pdone, enddate, enddate_wd,
+            self.addRow( cssclass, date, day.total, day.remaining, day.new, day.wip, day.done, enddate, enddate_wd,
                     self.graphColumn.getDayStateGraph( date, enddate_wd ) )
 
         return Markup(self.getContent())
@@ -215,13 +182,17 @@ class DebugDumpRenderer:
         pass
 
 
-    def render(self, entries, starttime, today, formatter ):
+    def render(self, series, today, formatter ):
         result = []
-        for entry in entries:
-            date = entry.endtime.date()
+        entries = series.entries if series.entries is not None else [ None ] * len(series.days)
+        for day, entry in zip( series.days, entries ):
+            date = day.endtime.date()
             result.append( "== %s" % date )
             result.append( "{{{" )
-            for t in entry.tickets:
+            result.append( "Total %.2f, Remaining %.2f, New %.2f, WiP %.2f, Done %.2f" % (
+                day.total, day.remaining, day.new, day.wip, day.done ) )
+            result.append( "End %s, End* %s, Delay %s" % ( day.end, day.endWorkdays, day.delay ) )
+            for t in ( entry.tickets if entry is not None else [] ):
                 result.append( "Ticket %s" % t.value_or( "id", "?" ) )
                 result.append( "  Status '%s'" % t.status )
                 result.append( "  Milestone '%s'" % t.milestone )
@@ -237,6 +208,30 @@ class DebugDumpRenderer:
         return Markup(out.getvalue())
 
 
+# Create a HistoryBuilder for the timetables with daily entries that end at
+# the end of the day.  The history cache, the worker pool and the snapshots
+# are used when they are enabled.
+def createHistoryBuilder( env, isInIteration ):
+    builder = history.HistoryBuilder( env, isInIteration )
+    builder.timestamp_to_datetime = lambda ts: from_timestamp( ts )
+    builder.datetime_to_timestamp = to_timestamp
+    historyCache = history_cache.TicketHistoryCache(env)
+    builder.historyCache = historyCache if historyCache.enabled else None
+    builder.workerPool = worker_pool.HistoryWorkerPool(env)
+    snapshotStore = snapshots.TicketSnapshots(env)
+    if snapshotStore.available:
+        builder.snapshotStore = snapshotStore
+    return builder
+
+
+# Create the BusinessCalendar for the forecasts of an iteration between the
+# dates @p first and @p last.  The forecasts usually end within a year after
+# the iteration.
+def createBusinessCalendar( env, first, last ):
+    return business_calendar.BusinessCalendarSettings(env).getCalendar(
+            first - dt.timedelta(days=7), last + dt.timedelta(days=366) )
+
+
 class BurnDownTableMacro(WikiMacroBase):
     def expand_macro(self, formatter, name, text, args):
         request = formatter.req
@@ -252,14 +247,63 @@ class BurnDownTableMacro(WikiMacroBase):
         options = optionReg.options()
         query_args = optionReg.query_args()
 
-        desired_fields = [self.tt_config.estimation_field]
-        desired_fields = desired_fields + self.tt_config.iteration_fields
+        # With debug=timing the stage times are added to the page.
+        stats = stage_stats.StageStats( name )
+        showTiming = options.pop( 'debug', None ) == 'timing'
+        retriever.stats = stats
+
+        # The table of a closed iteration does not change any more.
+        cache = render_cache.MacroRenderCache(self.env)
+        if cache.enabled:
+            with stats.stage( "cache" ):
+                realToday = dt.date.today()
+                cacheKey = cache.makeKey( name, options, query_args, realToday, request.href(),
+                        request.authname if retriever.vieableOnly else None )
+                permanent = ( options['enddate'] < realToday
+                        and retriever.is_milestone_completed( query_args['milestone'] ) )
+                version = None if permanent else retriever.get_milestone_data_version( query_args['milestone'] )
+                markup = cache.get( cacheKey, version )
+            if markup is not None:
+                stats.count( "cache_hits" )
+                add_stylesheet(request, 'tickethistory/css/burndowntable.css')
+                return stats.finish( self.log, markup, showTiming )
+
+        markup = self._render( formatter, retriever, options, query_args, stats )
+        if cache.enabled:
+            cache.put( cacheKey, markup, version, permanent )
+        return stats.finish( self.log, markup, showTiming )
+
+
+    def _render(self, formatter, retriever, options, query_args, stats):
+        entries, starttime, time_end = self._iterEntries( self.tt_config, retriever, options, query_args, stats )
+        today = options['today']
+
+        with stats.stage( "aggregation" ):
+            calendar = createBusinessCalendar( self.env, options['startdate'], max( options['enddate'], today ) )
+            series = burn_down_series.BurnDownSeries.fromEntries( self.tt_config, entries,
+                    starttime, time_end, calendar )
+        # To debug, use builder.fillTicketTimetable() and
+        # series.entries = timetable.entries
+        # renderer = DebugDumpRenderer( self.tt_config, self.env )
+        graph = BurnDownTableGraphColumn( self.tt_config, series )
+        renderer = HtmlBurnDownTableRenderer(self.tt_config, graph)
+        with stats.stage( "render" ):
+            return renderer.render( series, today, formatter )
+
 
-        isInIteration = self.tt_config.getIsInIteration( query_args );
+    # Retrieve the tickets and create the daily timetable of the table.
+    # Returns the lazily generated timetable entries with the start and the
+    # end time of the iteration.
+    def _iterEntries(self, tt_config, retriever, options, query_args, stats):
+        desired_fields = [tt_config.estimation_field]
+        desired_fields = desired_fields + tt_config.iteration_fields
 
-        builder = history.HistoryBuilder( self.env, isInIteration )
-        builder.timestamp_to_datetime = lambda ts: from_timestamp( ts )
+        isInIteration = tt_config.getIsInIteration( query_args );
+
+        builder = createHistoryBuilder( self.env, isInIteration )
+        builder.stats = stats
         tickets = retriever.retrieve( query_args, desired_fields )
+        stats.count( "tickets", len(tickets) )
 
         starttime = to_datetime(dt.datetime.combine(options['startdate'], dt.time.min))
         time_first = to_datetime(dt.datetime.combine(options['startdate'], dt.time.max))
@@ -277,10 +321,132 @@ class BurnDownTableMacro(WikiMacroBase):
             timetable.entries.append( history.TimetableEntry(
                     to_datetime(dt.datetime.combine(today, dt.time.max))) )
 
-        builder.fillTicketTimetable(tickets, timetable, [self.tt_config.estimation_field] )
+        # The entries are generated and aggregated one day at a time.
+        entries = builder.iterTimetableEntries(tickets, timetable, [tt_config.estimation_field] )
+        return stats.iterate( "propagation", entries ), starttime, time_end
 
-        graph = BurnDownTableGraphColumn( self.tt_config, timetable, starttime, time_end )
-        # renderer = DebugDumpRenderer( self.tt_config, self.env )
-        renderer = HtmlBurnDownTableRenderer(self.tt_config, graph)
-        return renderer.render( timetable.entries, starttime, today, formatter )
+
+class BurnDownDataHandler(Component):
+    """
+    Export the burn-down series of a milestone as JSON or CSV.  The request
+    takes the same arguments as the BurnDownTable macro:
+
+        /tickethistory/burndown.csv?milestone=m1&startdate=2017-01-02&enddate=2017-01-20
+
+    The rows are written while the history of the tickets is generated.  The
+    response carries an ETag and a Last-Modified header derived from the
+    latest change of the tickets in the milestone.  When the milestone did
+    not change, the response is "304 Not Modified" and no history is built.
+    """
+    implements(IRequestHandler)
+
+    columns = [ "date", "total", "remaining", "new", "wip", "done", "end", "end_workdays", "delay" ]
+    formats = { "json": "application/json", "csv": "text/csv; charset=utf-8" }
+
+    def match_request(self, req):
+        return req.path_info in ( '/tickethistory/burndown.json', '/tickethistory/burndown.csv' )
+
+
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW')
+        format = req.path_info.rsplit( '.', 1 )[1]
+
+        optionReg = BurnDownTableOptions()
+        optionReg.set_url_params( req.args )
+        try: optionReg.apply_defaults()
+        except ValueError: raise HTTPBadRequest( "Invalid date, expected YYYY-MM-DD" )
+        options = optionReg.options()
+        query_args = optionReg.query_args()
+        if 'milestone' not in query_args:
+            raise HTTPBadRequest( "No milestone specified" )
+        if not options.get('startdate'):
+            raise HTTPBadRequest( "No start date specified" )
+        optionReg.verify()
+        options.pop( 'debug', None )
+
+        retriever = dbutils.MilestoneRetriever( self.env, req )
+        version = retriever.get_milestone_data_version( query_args['milestone'] )
+        calendarVersion = business_calendar.BusinessCalendarSettings( self.env ).getVersion()
+        lastModified = self._lastModified( version, req.args )
+        if req.get_header( 'If-None-Match' ) is None and self._notModifiedSince( req, lastModified ):
+            self._sendNotModified( req )
+        req.check_modified( lastModified, [ format, sorted( options.items() ),
+                sorted( query_args.items() ), version, calendarVersion ] )
+
+        tt_config = history.TimetableConfig()
+        stats = retriever.stats
+        entries, starttime, time_end = BurnDownTableMacro( self.env )._iterEntries( tt_config,
+                retriever, options, query_args, stats )
+        calendar = createBusinessCalendar( self.env, options['startdate'],
+                max( options['enddate'], options['today'] ) )
+        days = burn_down_series.BurnDownSeries.iterDays( tt_config, entries, starttime, time_end, calendar )
+
+        req.send_response( 200 )
+        req.send_header( 'Content-Type', self.formats[format] )
+        req.send_header( 'Last-Modified', http_date( lastModified ) )
+        req.end_headers()
+        if format == 'json':
+            self._writeJson( req, query_args['milestone'], options, days )
+        else:
+            self._writeCsv( req, days )
+        stats.finish( self.log, None )
+        raise RequestDone
+
+
+    # The time of the latest change of the tickets in the milestone.  The
+    # default dates move at midnight, so the data is not older than the
+    # current day when a date is not given in the request.
+    def _lastModified(self, version, args):
+        lastModified = from_timestamp( version[1] if version and version[1] is not None else 0 )
+        if 'enddate' not in args or 'today' not in args:
+            midnight = to_datetime( dt.datetime.combine( dt.date.today(), dt.time.min ) )
+            lastModified = max( lastModified, midnight )
+        return lastModified
+
+
+    # True if the If-Modified-Since header of @p req is not older than
+    # @p lastModified.  The HTTP dates have a resolution of one second.
+    def _notModifiedSince(self, req, lastModified):
+        since = req.get_header( 'If-Modified-Since' )
+        parsed = email.utils.parsedate_tz( since ) if since else None
+        if parsed is None:
+            return False
+        return to_timestamp( lastModified ) // 1000000 <= email.utils.mktime_tz( parsed )
+
+
+    def _sendNotModified(self, req):
+        req.send_response( 304 )
+        req.send_header( 'Content-Length', 0 )
+        req.end_headers()
+        raise RequestDone
+
+
+    def _rowValues(self, day):
+        return [ day.endtime.date().isoformat(), day.total, day.remaining, day.new, day.wip, day.done,
+                None if day.end is None else day.end.date().isoformat(),
+                None if day.endWorkdays is None else day.endWorkdays.date().isoformat(),
+                day.delay ]
+
+
+    def _writeJson(self, req, milestone, options, days):
+        req.write( '{"milestone": %s, "startdate": "%s", "enddate": "%s", "days": [' % (
+                json.dumps( milestone ), options['startdate'], options['enddate'] ) )
+        separator = "\n"
+        for day in days:
+            req.write( separator + json.dumps( dict( zip( self.columns, self._rowValues( day ) ) ),
+                    sort_keys=True ) )
+            separator = ",\n"
+        req.write( "\n]}\n" )
+
+
+    def _writeCsv(self, req, days):
+        out = StringIO.StringIO()
+        writer = csv.writer( out, lineterminator="\r\n" )
+        writer.writerow( self.columns )
+        for day in days:
+            writer.writerow( [ "" if v is None else v for v in self._rowValues( day ) ] )
+            req.write( out.getvalue() )
+            out.seek( 0 )
+            out.truncate()
+        req.write( out.getvalue() )
 
@@ -0,0 +1,136 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import csv
+import threading
+import time, datetime as dt
+
+from trac.core import Component
+from trac.config import Option, ListOption
+from tickethistory import workdays
+
+
+def _parse_date( datestr ):
+    return dt.datetime(*time.strptime(datestr.strip(), "%Y-%m-%d")[0:5]).date()
+
+
+class HolidayWikiTable:
+    """
+    Read the holidays from a CSV table in a wiki page.
+
+    The table is enclosed in a preformat block like the table of
+    IterationInfoWikiTable.  The first column holds the date in ISO format
+    (YYYY-MM-DD); the other columns are ignored.  The lines with invalid
+    dates are skipped.  The parsed tables are shared between the requests
+    and parsed again when the version of the page changes.
+    """
+    _parsed = {} # ( environment path, page name ) -> ( version, holidays )
+    _lock = threading.Lock()
+
+    def __init__(self, env, wikipage):
+        self.env = env
+        self.wikiPage = wikipage
+
+
+    # The current version of the wiki page or None if the page does not exist.
+    def getVersion(self):
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute( "SELECT MAX(version) FROM wiki WHERE name=%s", ( self.wikiPage, ) )
+            for row in cursor:
+                return row[0]
+            return None
+
+
+    def getHolidays(self):
+        version = self.getVersion()
+        if version is None:
+            return []
+
+        key = ( self.env.path, self.wikiPage )
+        with self._lock:
+            parsed = self._parsed.get( key )
+        if parsed is not None and parsed[0] == version:
+            return parsed[1]
+
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute( "SELECT text FROM wiki WHERE name=%s AND version=%s", ( self.wikiPage, version ) )
+            text = ""
+            for row in cursor:
+                text = row[0]
+
+        holidays = self.extractHolidays( text )
+        with self._lock:
+            self._parsed[key] = ( version, holidays )
+        return holidays
+
+
+    def extractHolidays(self, text):
+        table = []
+        inblock = False
+        for line in text.split( "\n" ):
+            line = line.strip()
+            if not inblock:
+                if line.startswith("{{{"):
+                    inblock = True
+            elif line == "}}}":
+                break
+            elif len(line) > 0:
+                table.append( line )
+
+        holidays = []
+        for row in csv.reader(table, delimiter=',', quotechar='"'):
+            if len(row) < 1:
+                continue
+            try: holidays.append( _parse_date( row[0] ) )
+            except: pass
+        return holidays
+
+
+class BusinessCalendarSettings(Component):
+    """
+    Create the BusinessCalendar used for the forecasts of the burn-down
+    tables from the options in trac.ini.
+    """
+
+    workweek = Option('tickethistory', 'workweek', workdays.WEEKMASK,
+            """The workdays of the week from Monday to Sunday: 1 for a
+            workday and 0 for a day off.""")
+
+    holidays = ListOption('tickethistory', 'holidays', '',
+            doc="""A comma separated list of holidays (YYYY-MM-DD).""")
+
+    holidays_page = Option('tickethistory', 'holidays_page', '',
+            """The wiki page with a CSV table of holidays.  The first column
+            of the table holds the date (YYYY-MM-DD).""")
+
+
+    def getHolidays(self):
+        holidays = set()
+        for datestr in self.holidays:
+            try: holidays.add( _parse_date( datestr ) )
+            except ValueError:
+                self.log.warning( "Invalid holiday '%s' in trac.ini", datestr )
+        if self.holidays_page:
+            holidays.update( HolidayWikiTable( self.env, self.holidays_page ).getHolidays() )
+        return sorted( holidays )
+
+
+    # Return a value that changes whenever the workdays or the holidays are
+    # changed in trac.ini or in the holidays page.
+    def getVersion(self):
+        pageVersion = HolidayWikiTable( self.env, self.holidays_page ).getVersion() if self.holidays_page else None
+        return ( self.workweek, tuple( self.holidays ), self.holidays_page, pageVersion )
+
+
+    # Create a calendar with the workday index for the dates between @p first
+    # and @p last.  The forecasts after @p last are calculated without the
+    # index.
+    def getCalendar(self, first, last):
+        try:
+            return workdays.BusinessCalendar( self.workweek, self.getHolidays(), first, last )
+        except ValueError:
+            self.log.warning( "Invalid workweek '%s' in trac.ini", self.workweek )
+            return workdays.BusinessCalendar( workdays.WEEKMASK, self.getHolidays(), first, last )
@@ -3,12 +3,65 @@
 ## Licensed under the MIT License. See LICENSE file in the project root for full license information.
 
 from trac.ticket.query import Query
+from trac.ticket.api import TicketSystem
+from trac.ticket.model import Milestone
+from trac.perm import PermissionSystem
+from trac.resource import ResourceNotFound
+from trac.util import as_bool
+from trac.util.datefmt import from_utimestamp as from_timestamp
+from tickethistory import stage_stats
 import copy
 
 
+# Select the ids of the tickets that were at any time part of a milestone.
+# The milestone name is passed three times as an argument.  Every part of the
+# UNION can use an index on ticket_change (field, newvalue) or (field,
+# oldvalue); see the command 'trac-admin <env> tickethistory index'.
+_milestone_ticket_ids_sql = ( "SELECT t.id FROM ticket t WHERE t.milestone=%s "
+        "UNION SELECT c.ticket FROM ticket_change c WHERE c.field='milestone' AND c.oldvalue=%s "
+        "UNION SELECT c.ticket FROM ticket_change c WHERE c.field='milestone' AND c.newvalue=%s" )
+
+
+# Return the statement and the arguments that select the ids of the tickets
+# that were at any time part of one of the @p milestones.
+def _milestones_ticket_ids_sql( milestones ):
+    if len(milestones) == 1:
+        return _milestone_ticket_ids_sql, [ milestones[0] ] * 3
+    names = ",".join( ["%s"] * len(milestones) )
+    sql = ( "SELECT t.id FROM ticket t WHERE t.milestone IN (%s) "
+        "UNION SELECT c.ticket FROM ticket_change c WHERE c.field='milestone' AND c.oldvalue IN (%s) "
+        "UNION SELECT c.ticket FROM ticket_change c WHERE c.field='milestone' AND c.newvalue IN (%s)" ) % (
+            names, names, names )
+    return sql, list( milestones ) * 3
+
+
+# The TicketQuery arguments that do not constrain the set of tickets.
+_presentation_args = set([ 'max', 'page', 'order', 'desc', 'group', 'groupdesc',
+    'verbose', 'col', 'row', 'report', 'format' ])
+
+# The columns of the ticket table that hold the time of an event.
+_time_columns = set([ 'time', 'changetime' ])
+
+# The permission policies that decide without looking at the resource.
+_coarse_policies = set([ 'DefaultPermissionPolicy', 'LegacyAttachmentPolicy' ])
+
+# The permissions that allow to view a ticket.
+_view_actions = ( 'TICKET_VIEW', 'TICKET_VIEW_CC' )
+
+
 def _clean_args( args ):
     return args
 
+# Convert a list of ticket ids to the TicketQuery range syntax: 1-3|5|7-9.
+def to_id_ranges( ids ):
+    ranges = []
+    for tid in sorted( set( ids ) ):
+        if len(ranges) > 0 and ranges[-1][1] == tid - 1:
+            ranges[-1][1] = tid
+        else:
+            ranges.append( [tid, tid] )
+    return "|".join( ("%d" % a) if a == b else ("%d-%d" % (a, b)) for a, b in ranges )
+
 def to_query_string( args ):
     return '&'.join('%s=%s' % item for item in args.iteritems())
 
@@ -23,6 +76,8 @@ class Retriever(object):
         self.env = env
         self.request = request
         self.vieableOnly = False
+        # The StageStats of the macro that uses the retriever.
+        self.stats = stage_stats.StageStats()
 
 
     def get_tickets(self, query_args, extra_columns=None):
@@ -37,16 +92,54 @@ class Retriever(object):
         self.env.log.debug("Retrieve: %s", query_args)
         query_string = to_query_string( _clean_args(query_args) )
 
-        query = Query.from_string(self.env, query_string)
-        return query.execute(self.request)
+        with self.stats.stage( "query" ):
+            query = Query.from_string(self.env, query_string)
+            self.stats.count( "queries" )
+            return query.execute(self.request)
+
+
+    # Return the tickets that the user may view.  The tickets are not checked
+    # one by one if the user holds a view permission globally and only the
+    # coarse policies are active.  The decisions are kept for the rest of
+    # the request.
+    def filter_viewable_tickets(self, tickets):
+        with self.stats.stage( "permissions" ):
+            perm = self.request.perm
+            if not self._has_fine_grained_policies() and \
+                    any( action in perm for action in _view_actions ):
+                return tickets
+
+            decisions = getattr( self.request, '_tickethistory_viewable', None )
+            if decisions is None:
+                decisions = {}
+                self.request._tickethistory_viewable = decisions
+            user = self.request.authname
+            viewable = []
+            for t in tickets:
+                key = ( user, t['id'] )
+                allowed = decisions.get( key )
+                if allowed is None:
+                    ticket_perm = perm( 'ticket', t['id'] )
+                    allowed = any( action in ticket_perm for action in _view_actions )
+                    decisions[key] = allowed
+                if allowed:
+                    viewable.append( t )
+
+            dropped = len(tickets) - len(viewable)
+            if dropped > 0:
+                self.stats.count( "hidden_tickets", dropped )
+                self.env.log.debug( "Retrieve: %d of %d tickets are not viewable", dropped, len(tickets) )
+            return viewable
+
+
+    def _has_fine_grained_policies(self):
+        return any( policy.__class__.__name__ not in _coarse_policies
+                for policy in PermissionSystem(self.env).policies )
 
 
     def get_viewable_tickets(self, query_args, extra_columns=None):
         tickets = self.get_tickets( query_args, extra_columns )
-        tickets = [t for t in tickets
-                   if ('TICKET_VIEW' or 'TICKET_VIEW_CC')
-                   in self.request.perm('ticket', t['id'])]
-        return tickets
+        return self.filter_viewable_tickets( tickets )
 
 
     def retrieve( self, query_args, extra_columns=None ):
@@ -68,24 +161,146 @@ class MilestoneRetriever(Retriever):
 
 
     def get_ticket_ids_in_milestone( self, milestone ):
+        return self.get_ticket_ids_in_milestones( [ milestone ] )
+
+
+    def get_ticket_ids_in_milestones( self, milestones ):
+        sql, args = _milestones_ticket_ids_sql( milestones )
+        self.stats.count( "queries" )
         with self.env.db_query as database:
             tid_cursor = database.cursor()
-            tid_cursor.execute("SELECT "
-                "DISTINCT t.id "
-                "FROM ticket t LEFT JOIN ticket_change c "
-                "ON c.ticket = t.id "
-                "  WHERE (t.milestone=%s OR (field='milestone' AND (c.oldvalue=%s OR c.newvalue=%s) ) )"
-                "", [ milestone, milestone, milestone ])
+            tid_cursor.execute( sql, args )
 
             return sorted( [int(row[0]) for row in tid_cursor] )
 
 
+    # Return { ticket id: changetime } of the tickets that were at any time
+    # part of the milestone and changed after the timestamp @p since.
+    def get_changed_tickets_in_milestone( self, milestone, since ):
+        self.stats.count( "queries" )
+        with self.env.db_query as database:
+            cursor = database.cursor()
+            cursor.execute( "SELECT t.id, t.changetime FROM ticket t "
+                "WHERE t.changetime > %s AND t.id IN (" + _milestone_ticket_ids_sql + ")",
+                [ since, milestone, milestone, milestone ] )
+            return dict( ( int(tid), changetime ) for tid, changetime in cursor )
+
+
+    # Return a value that changes whenever a ticket that was at any time part
+    # of the milestone is changed: ( number of tickets, max ticket.changetime,
+    # checksum of ticket.changetime ).  Every ticket change also updates
+    # ticket.changetime.  The checksum detects the changes of older tickets,
+    # eg. when a ticket change is deleted.  The membership subquery is
+    # executed once.
+    def get_milestone_data_version( self, milestone ):
+        self.stats.count( "queries" )
+        with self.env.db_query as database:
+            cursor = database.cursor()
+            cursor.execute( "SELECT COUNT(*), MAX(t.changetime), SUM(t.changetime / 1000) "
+                "FROM ticket t WHERE t.id IN (" + _milestone_ticket_ids_sql + ")",
+                [ milestone, milestone, milestone ] )
+            for row in cursor:
+                return tuple( row )
+            return None
+
+
+    def is_milestone_completed( self, milestone ):
+        try: return Milestone( self.env, milestone ).is_completed
+        except ResourceNotFound: return False
+
+
+    def get_tickets_in_milestone( self, milestone, extra_columns=None ):
+        return self.get_tickets_in_milestones( [ milestone ], extra_columns )
+
+
+    # Retrieve the tickets that were at any time part of one of the
+    # milestones with two statements, one for the ticket table and one for
+    # the custom fields.  The result has the same form as the result of
+    # Query.execute.  The standard fields except the description and the
+    # custom fields listed in @p extra_columns are retrieved.
+    def get_tickets_in_milestones( self, milestones, extra_columns=None ):
+        ticket_fields = TicketSystem(self.env).get_ticket_fields()
+        custom = {}
+        columns = [ 'id', 'time', 'changetime' ]
+        for f in ticket_fields:
+            name = f['name']
+            if f.get('custom'):
+                if extra_columns is not None and name in extra_columns:
+                    custom[name] = f
+            elif name not in columns and (name != 'description' or
+                    (extra_columns is not None and name in extra_columns)):
+                columns.append( name )
+
+        membership, args = _milestones_ticket_ids_sql( milestones )
+        tickets = {}
+        with self.env.db_query as database:
+            cursor = database.cursor()
+            self.stats.count( "queries" )
+            cursor.execute( "SELECT %s FROM ticket t WHERE t.id IN (%s)" % (
+                ",".join( "t.%s" % database.quote(c) for c in columns ),
+                membership ), args )
+            for row in cursor:
+                ticket = {}
+                for name, val in zip( columns, row ):
+                    if name == 'id':
+                        val = int(val)
+                        ticket['href'] = self.request.href.ticket(val)
+                    elif name == 'reporter':
+                        val = val or 'anonymous'
+                    elif name in _time_columns:
+                        val = from_timestamp(val)
+                    elif val is None:
+                        val = ''
+                    ticket[name] = val
+                for name in custom:
+                    ticket[name] = ''
+                tickets[ticket['id']] = ticket
+
+            if len(custom) > 0 and len(tickets) > 0:
+                names = sorted( custom.keys() )
+                self.stats.count( "queries" )
+                cursor.execute( "SELECT c.ticket, c.name, c.value FROM ticket_custom c "
+                    "WHERE c.name IN (%s) AND c.ticket IN (%s)" % (
+                        ",".join( ["%s"] * len(names) ), membership ),
+                    names + args )
+                for tid, name, val in cursor:
+                    ticket = tickets.get( int(tid) )
+                    if ticket is None:
+                        continue
+                    if custom[name]['type'] == 'checkbox':
+                        val = as_bool(val)
+                    elif val is None:
+                        val = ''
+                    ticket[name] = val
+
+        return [ tickets[tid] for tid in sorted( tickets.keys() ) ]
+
+
     def retrieve( self, query_args, extra_columns=None ):
-        milestone = query_args['milestone']
-        ids = self.get_ticket_ids_in_milestone( milestone )
+        return self.retrieve_milestones( [ query_args['milestone'] ], query_args, extra_columns )
+
+
+    # Retrieve the tickets that were at any time part of one of the
+    # @p milestones in a single pass.  The 'milestone' attribute of
+    # @p query_args is ignored.
+    def retrieve_milestones( self, milestones, query_args, extra_columns=None ):
+        constraints = [ k for k in query_args if k != 'milestone' and k not in _presentation_args ]
+        if len(constraints) == 0:
+            with self.stats.stage( "membership" ):
+                tickets = self.get_tickets_in_milestones( milestones, extra_columns )
+            if self.vieableOnly:
+                tickets = self.filter_viewable_tickets( tickets )
+            return tickets
+
+        # Other constraints are handled by the ticket query.  The ids are
+        # passed as ranges to keep the query string and the SQL short.
+        with self.stats.stage( "membership" ):
+            ids = self.get_ticket_ids_in_milestones( milestones )
+        if len(ids) == 0:
+            return []
         query_args = copy.copy( query_args )
-        query_args["id"] = "|".join( ["%d" % tid for tid in ids] )
-        del query_args['milestone']
+        query_args["id"] = to_id_ranges( ids )
+        query_args.pop( 'milestone', None )
 
         return super(MilestoneRetriever, self).retrieve( query_args, extra_columns )
 
@@ -0,0 +1,141 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import threading
+from collections import OrderedDict
+
+from trac.core import Component, implements
+from trac.config import BoolOption, IntOption
+from trac.ticket.api import ITicketChangeListener
+from trac.util.datefmt import to_utimestamp as to_timestamp
+
+
+class _CachedTicketHistory:
+    def __init__(self, changetime):
+        self.changetime = changetime # ticket.changetime when the rows were retrieved
+        self.rows = [] # (field, time, oldvalue, newvalue) in chronological order
+
+
+class TicketHistoryCache(Component):
+    """
+    Keep the change rows of the tickets between the requests.
+
+    The rows are stored per set of retrieved fields.  A ticket is up to date
+    while its `changetime` matches the `changetime` that was seen when the
+    rows were retrieved.  For the tickets that changed since then only the
+    rows newer than the previous `changetime` are retrieved.  The least
+    recently used histories are removed when the cache is full.
+    """
+    implements(ITicketChangeListener)
+
+    enabled = BoolOption('tickethistory', 'history_cache', 'true',
+            """Keep the ticket history between the requests and retrieve
+            only the changes that were made after the last request.""")
+
+    size = IntOption('tickethistory', 'history_cache_size', 20000,
+            """The maximum number of ticket histories that are kept in the
+            cache.  A ticket has a history for every set of retrieved
+            fields.""")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # ( frozenset(fields), ticket_id ) -> _CachedTicketHistory
+
+
+    # Generate the change rows (ticket, field, time, oldvalue, newvalue) for
+    # the @p tickets.  The rows of each ticket are in chronological order.
+    # @p loadRows( ticketIds, historySettings, since ) retrieves the rows
+    # newer than the timestamp @p since from the database.
+    def iterChangeRows( self, tickets, historySettings, loadRows ):
+        if not self.enabled:
+            for row in loadRows( [t['id'] for t in tickets], historySettings, None ):
+                yield row
+            return
+
+        fields = frozenset( historySettings.fields )
+        with self._lock:
+            current = {}
+            stale = {}
+            for t in tickets:
+                tid = t['id']
+                changetime = t.get( 'changetime' )
+                cached = self._entries.pop( ( fields, tid ), None )
+                if cached is not None:
+                    self._entries[( fields, tid )] = cached # most recently used
+                if cached is not None and cached.changetime is not None and changetime is not None:
+                    if cached.changetime == changetime:
+                        current[tid] = cached.rows
+                        continue
+                    if cached.changetime < changetime:
+                        stale[tid] = ( cached, changetime )
+                        continue
+                stale[tid] = ( None, changetime )
+
+        for tid, rows in current.iteritems():
+            for row in rows:
+                yield ( tid, ) + row
+
+        if len( stale ) == 0:
+            return
+        self.log.debug( "TicketHistoryCache: %d tickets up to date, %d to update",
+                len( current ), len( stale ) )
+
+        fresh = {}
+        known = {}
+        for tid, ( cached, changetime ) in stale.iteritems():
+            fresh[tid] = _CachedTicketHistory( changetime )
+            if cached is not None:
+                fresh[tid].rows = list( cached.rows )
+                known[tid] = to_timestamp( cached.changetime )
+
+        # The tickets that are not in the cache need the complete history.
+        # The others need only the rows added after the cached changetime.
+        # The incremental query may return some rows that are already
+        # cached; they are skipped.
+        unknown = [ tid for tid in stale if tid not in known ]
+        if len( unknown ) > 0:
+            for row in loadRows( unknown, historySettings, None ):
+                fresh[row[0]].rows.append( row[1:] )
+        if len( known ) > 0:
+            for row in loadRows( known.keys(), historySettings, min( known.itervalues() ) ):
+                if row[2] > known[row[0]]:
+                    fresh[row[0]].rows.append( row[1:] )
+
+        with self._lock:
+            for tid, entry in fresh.iteritems():
+                if entry.changetime is not None:
+                    self._entries.pop( ( fields, tid ), None )
+                    self._entries[( fields, tid )] = entry
+            while len( self._entries ) > max( 0, self.size ):
+                self._entries.popitem( last=False )
+        for tid, entry in fresh.iteritems():
+            for row in entry.rows:
+                yield ( tid, ) + row
+
+
+    def invalidate( self, ticketId=None ):
+        with self._lock:
+            if ticketId is None:
+                self._entries.clear()
+                return
+            for key in [ k for k in self._entries if k[1] == ticketId ]:
+                del self._entries[key]
+
+
+    # ITicketChangeListener methods
+
+    def ticket_created(self, ticket):
+        pass
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        pass
+
+    def ticket_deleted(self, ticket):
+        self.invalidate( ticket.id )
+
+    def ticket_comment_modified(self, ticket, cdate, author, comment, old_comment):
+        pass
+
+    def ticket_change_deleted(self, ticket, cdate, changes):
+        self.invalidate( ticket.id )
@@ -0,0 +1,46 @@
+// Update a live TaskBoard in place.  The board polls the url in its
+// data-updates attribute for the tickets that changed after data-since and
+// replaces their notes (see TaskBoardUpdateHandler).
+jQuery(function($) {
+  var interval = 60000;
+
+  $("div.tickethist-board[data-updates]").each(function() {
+    var board = $(this);
+
+    function notesOf(id) {
+      return board.find('div.note-box[data-ticket="' + id + '"]');
+    }
+
+    function apply(data) {
+      var columns = board.find("div.column-content");
+      var changed = {};
+      $.each(data.tickets, function(i, t) {
+        (changed[t.id] = changed[t.id] || []).push(t);
+      });
+      $.each(data.removed, function(i, id) {
+        notesOf(id).remove();
+      });
+      $.each(changed, function(id, notes) {
+        var old = notesOf(id);
+        // A note that stays in its column keeps its position.
+        if (notes.length == 1 && old.length == 1 &&
+            old.closest("div.column-content")[0] == columns[notes[0].column]) {
+          old.replaceWith(notes[0].html);
+          return;
+        }
+        old.remove();
+        $.each(notes, function(i, t) {
+          $(columns[t.column]).append(t.html);
+        });
+      });
+      board.attr("data-since", data.since);
+    }
+
+    function update() {
+      $.getJSON(board.attr("data-updates"), { since: board.attr("data-since") }, apply)
+        .always(function() { setTimeout(update, interval); });
+    }
+
+    setTimeout(update, interval);
+  });
+});
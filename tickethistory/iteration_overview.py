@@ -0,0 +1,176 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import time
+import datetime as dt
+
+from trac.wiki.macros import WikiMacroBase
+from trac.util.datefmt import to_datetime
+from trac.core import TracError
+from trac.web.chrome import add_stylesheet
+from genshi.core import Markup, escape
+from tickethistory import options, dbutils, burn_down_series, iterationinfo, ticket_timetable as history
+from tickethistory.burn_down_table import BurnDownTableGraphColumn, createHistoryBuilder, createBusinessCalendar
+
+
+class IterationOverviewOptions(options.OptionRegistry):
+    def __init__(self):
+        super(IterationOverviewOptions, self).__init__(["table", "iterations", "today"])
+        self._overrides = None
+
+
+    def get_parameter_sets(self):
+        return (self.iniParams, self.macroParams, self.urlParams, self._overrides)
+
+
+    def apply_defaults(self):
+        self._overrides = {}
+        options = self.options()
+
+        if "today" in options:
+            self._overrides["today"] = dt.datetime(*time.strptime(options["today"], "%Y-%m-%d")[0:5]).date()
+        else:
+            self._overrides["today"] = dt.datetime.now().date()
+
+        names = options.get("iterations")
+        if names:
+            self._overrides["iterations"] = [ n.strip() for n in names.split("|") if len(n.strip()) > 0 ]
+
+
+    def verify(self):
+        options = self.options()
+        if not options.get('table'):
+            raise TracError("No iteration table specified!")
+
+
+class IterationSeries:
+    """
+    The burn-down series of an iteration and the day that represents the
+    state of the iteration.
+    """
+    def __init__(self, iteration, series, today):
+        self.iteration = iteration
+        self.series = series
+        self.day = None
+        refdate = min( max( today, iteration.startdate ), iteration.enddate )
+        for day in series.days:
+            if day.endtime.date() <= refdate:
+                self.day = day
+
+
+class HtmlIterationOverviewRenderer:
+    def __init__(self, timeTableConfig):
+        self.tt_config = timeTableConfig
+        self.columns = [ "Iteration", "Start", "End", "Total", "Done", "Remain", "End*", "Delay" ]
+        self.alignments = [ "left", "left", "left", "right", "right", "right", "left", "initial" ]
+
+
+    def render(self, iterationSeries, today, formatter):
+        add_stylesheet(formatter.req, 'tickethistory/css/burndowntable.css')
+
+        content = [ '<table class="burn-down-table">', "<tr>" ]
+        content += [ '<th style="text-align:%s;">%s</th>' % (self.alignments[ic], c)
+                for ic, c in enumerate(self.columns) ]
+        content.append( "</tr>" )
+        for its in iterationSeries:
+            iteration = its.iteration
+            day = its.day
+            graph = BurnDownTableGraphColumn( self.tt_config, its.series )
+            if iteration.startdate <= today <= iteration.enddate: cssclass = "today"
+            else: cssclass = "normal"
+            link = '<a href="%s">%s</a>' % ( escape( formatter.href.milestone( iteration.name ) ),
+                    escape( iteration.name ) )
+            if day is None:
+                values = [ link, iteration.startdate, iteration.enddate, None, None, None, None, None ]
+            else:
+                wd_end = None if day.endWorkdays is None else day.endWorkdays.date()
+                values = [ link, iteration.startdate, iteration.enddate,
+                        "%.1f" % day.total, "%.1f" % day.done, "%.1f" % day.remaining, wd_end,
+                        graph.getDayStateGraph( day.endtime.date(), wd_end ) ]
+            content.append( "<tr>" )
+            content += [ '<td class="%s" style="text-align:%s;">%s</td>' % (cssclass, self.alignments[ic],
+                    v if v is not None else "") for ic, v in enumerate(values) ]
+            content.append( "</tr>" )
+        content.append( "</table>" )
+        return Markup( "".join( content ) )
+
+
+class IterationOverviewMacro(WikiMacroBase):
+    """
+    Show the state of several iterations in a table.
+
+    The iterations are read from a CSV table in a wiki page (see
+    IterationInfoWikiTable).  The name of an iteration is the name of its
+    milestone.  The tickets of all the iterations are retrieved with one
+    membership query and their history is read in a single pass.
+
+        [[IterationOverview(table=Sprints,iterations=Sprint1|Sprint2)]]
+    """
+    def expand_macro(self, formatter, name, text, args):
+        request = formatter.req
+
+        self.tt_config = history.TimetableConfig()
+
+        optionReg = IterationOverviewOptions()
+        optionReg.set_macro_params(text)
+        optionReg.set_url_params(request.args)
+        optionReg.apply_defaults()
+        optionReg.verify()
+        options = optionReg.options()
+        query_args = optionReg.query_args()
+
+        iterationTable = iterationinfo.IterationInfoWikiTable( self.env, options['table'] )
+        iterations = iterationTable.getIterationList()
+        if 'iterations' in options:
+            byName = { i.name : i for i in iterations }
+            iterations = [ byName[n] for n in options['iterations'] if n in byName ]
+        if len(iterations) == 0:
+            raise TracError("No iterations found in '%s'!" % options['table'])
+
+        return self._render( formatter, iterations, options, query_args )
+
+
+    def _render(self, formatter, iterations, options, query_args):
+        retriever = dbutils.MilestoneRetriever(self.env, formatter.req)
+        desired_fields = [self.tt_config.estimation_field] + self.tt_config.iteration_fields
+
+        # The union of the tickets of all the iterations in a single pass.
+        tickets = retriever.retrieve_milestones( [ i.name for i in iterations ], query_args, desired_fields )
+        tickets.sort( key=lambda t: t['id'] )
+
+        # One daily timetable that covers all the iterations.
+        today = options['today']
+        delta = dt.timedelta(days=1)
+        firstdate = min( i.startdate for i in iterations )
+        lastdate = max( i.enddate for i in iterations )
+        timetable = history.Timetable( to_datetime(dt.datetime.combine(firstdate, dt.time.min)) )
+        date = firstdate
+        while date <= lastdate:
+            timetable.entries.append( history.TimetableEntry( to_datetime(dt.datetime.combine(date, dt.time.max)) ) )
+            date += delta
+
+        # Distribute the states of the tickets to the entries of the
+        # iterations while the timetable is generated.
+        builder = createHistoryBuilder( self.env, None )
+        isInIteration = [ self.tt_config.getIsInIteration( { 'milestone': i.name } ) for i in iterations ]
+        iterationEntries = [ [] for i in iterations ]
+        for entry in builder.iterTimetableEntries( tickets, timetable, [self.tt_config.estimation_field] ):
+            date = entry.endtime.date()
+            for i, iteration in enumerate( iterations ):
+                if iteration.startdate <= date <= iteration.enddate:
+                    part = history.TimetableEntry( entry.endtime )
+                    part.tickets = [ t for t in entry.tickets if isInIteration[i]( t ) ]
+                    iterationEntries[i].append( part )
+
+        calendar = createBusinessCalendar( self.env, firstdate, max( lastdate, today ) )
+        iterationSeries = []
+        for iteration, entries in zip( iterations, iterationEntries ):
+            starttime = to_datetime(dt.datetime.combine(iteration.startdate, dt.time.min))
+            endtime = to_datetime(dt.datetime.combine(iteration.enddate, dt.time.max))
+            series = burn_down_series.BurnDownSeries.fromEntries( self.tt_config, entries, starttime, endtime,
+                    calendar )
+            iterationSeries.append( IterationSeries( iteration, series, today ) )
+
+        renderer = HtmlIterationOverviewRenderer( self.tt_config )
+        return renderer.render( iterationSeries, today, formatter )
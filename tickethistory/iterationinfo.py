@@ -3,7 +3,9 @@
 ## Licensed under the MIT License. See LICENSE file in the project root for full license information.
 
 from trac.wiki.model import WikiPage
+import bisect
 import csv
+import threading
 import time, datetime as dt
 
 
@@ -22,6 +24,53 @@ class IterationInfo:
         return dt.datetime(*time.strptime(datestr, "%Y-%m-%d")[0:5]).date()
 
 
+class IterationIndex:
+    """
+    Find the iterations by name and by date.  The iterations are sorted by
+    the start date; the running maximum of the end dates limits the number
+    of iterations that are checked for a date.
+    """
+    def __init__(self, iterations):
+        self.iterations = iterations
+        self.byName = {}
+        for i in iterations:
+            self.byName.setdefault( i.name, i )
+        order = sorted( range(len(iterations)), key=lambda k: iterations[k].startdate )
+        self._order = order
+        self._starts = [ iterations[k].startdate for k in order ]
+        self._maxEnds = []
+        maxEnd = None
+        for k in order:
+            if maxEnd is None or iterations[k].enddate > maxEnd:
+                maxEnd = iterations[k].enddate
+            self._maxEnds.append( maxEnd )
+
+
+    # Return the iterations that contain @p date in the order of the table.
+    def getIterationsByDate(self, date):
+        found = []
+        i = bisect.bisect_right( self._starts, date ) - 1
+        while i >= 0 and self._maxEnds[i] >= date:
+            k = self._order[i]
+            if self.iterations[k].enddate >= date:
+                found.append( k )
+            i -= 1
+        return [ self.iterations[k] for k in sorted( found ) ]
+
+
+class _ParsedPage:
+    def __init__(self, version, iterations):
+        self.version = version
+        self.index = IterationIndex( iterations )
+
+
+# The parsed iteration tables shared by all the requests of the process.
+# Keyed by ( environment path, page name ); the entry holds the version of
+# the page that was parsed.
+_parsedPages = {}
+_parsedPagesLock = threading.Lock()
+
+
 class IterationInfoWikiTable:
     """
     Read the information about iterations from a CSV table in a wiki page.
@@ -35,12 +84,17 @@ class IterationInfoWikiTable:
     invalid dates are skipped.
 
     This is an alterntive for not using a real table.
+
+    The version of the page is checked once per instance; create a table for
+    each request.  The parsed table is shared between the requests and the
+    text of the page is read and parsed again only when its version changes.
     """
     def __init__(self, env, wikipage):
         self.env = env
         self.wikiPage = wikipage
         self.retrievedVersion = None
         self.iterations = []
+        self._index = IterationIndex( [] )
 
 
     def getIterationList(self):
@@ -50,28 +104,47 @@ class IterationInfoWikiTable:
 
     def getIterationByName(self, name):
         self.reloadIterations()
-        for i in self.iterations:
-            if i.name == name:
-                return i
-        return None
+        return self._index.byName.get( name )
 
 
     def getIterationsByDate(self, date):
         self.reloadIterations()
-        res = [ i for i in self.iterations
-                if date >= i.startdate and date <= i.enddate ]
-        return res
+        return self._index.getIterationsByDate( date )
+
 
+    def getVersion(self):
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute( "SELECT MAX(version) FROM wiki WHERE name=%s", ( self.wikiPage, ) )
+            for row in cursor:
+                return row[0]
+            return None
 
+
+    # The version of the page is checked once in the lifetime of the table,
+    # ie. once per request or render.  The text is read and parsed only when
+    # the version differs from the one in the shared cache.
     def reloadIterations(self):
-        page = WikiPage(self.env, self.wikiPage)
-        if page == None or not page.exists:
-            return
         if self.retrievedVersion is not None:
-            if self.retrievedVersion >= page.version:
+            return
+        version = self.getVersion()
+        if version is None:
+            return
+
+        key = ( self.env.path, self.wikiPage )
+        with _parsedPagesLock:
+            parsed = _parsedPages.get( key )
+        if parsed is None or parsed.version != version:
+            page = WikiPage(self.env, self.wikiPage, version)
+            if not page.exists:
                 return
-        self.iterations = self.extractIterations(self, page.text)
-        self.retrievedVersion = page.version
+            parsed = _ParsedPage( version, self.extractIterations( page.text ) )
+            with _parsedPagesLock:
+                _parsedPages[key] = parsed
+
+        self.iterations = parsed.index.iterations
+        self._index = parsed.index
+        self.retrievedVersion = version
 
 
     def extractIterations(self, text):
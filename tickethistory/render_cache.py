@@ -0,0 +1,100 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import threading
+import time
+from collections import OrderedDict
+
+from trac.core import Component
+from trac.config import IntOption
+
+
+class _CachedMarkup:
+    def __init__(self, markup, version, expires):
+        self.markup = markup
+        self.version = version # data version; None for permanent entries
+        self.expires = expires # time.time() after which the entry is stale; None never
+
+
+class MacroRenderCache(Component):
+    """
+    Keep the markup rendered by the macros.
+
+    An entry is keyed on the normalized macro options and query arguments.
+    It is valid until its TTL expires or until the data version of the
+    involved tickets changes.  Permanent entries are used for the data that
+    can not change any more (past-dated boards, closed iterations); they
+    never expire and their data version is not checked.  The least recently
+    used entries are removed when the cache is full.
+    """
+
+    size = IntOption('tickethistory', 'render_cache_size', 100,
+            """The maximum number of rendered macros that are kept in the
+            cache.  Set to 0 to disable the cache.""")
+
+    ttl = IntOption('tickethistory', 'render_cache_ttl', 300,
+            """The number of seconds that a rendered macro is kept in the
+            cache.""")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    @property
+    def enabled( self ):
+        return self.size > 0
+
+
+    @staticmethod
+    def makeKey( name, options, query_args, *extra ):
+        def normalized( params ):
+            return tuple( sorted( ( unicode(k), unicode(v) ) for k, v in params.iteritems() ) )
+        return ( name, normalized( options ), normalized( query_args ) ) + tuple( extra )
+
+
+    # Return the cached markup or None.  The @p version is ignored for
+    # permanent entries.
+    def get( self, key, version=None ):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop( key, None )
+            if entry is not None:
+                valid = ( entry.expires is None or now < entry.expires ) and \
+                        ( entry.version is None or entry.version == version )
+                if valid:
+                    self._entries[key] = entry # most recently used
+                    self.hits += 1
+            else:
+                valid = False
+            if not valid:
+                self.misses += 1
+            hits, misses = self.hits, self.misses
+        self.log.debug( "MacroRenderCache %s: %s (hits=%d, misses=%d)", key[0],
+                "hit" if valid else "miss", hits, misses )
+        return entry.markup if valid else None
+
+
+    def put( self, key, markup, version=None, permanent=False ):
+        if not self.enabled:
+            return
+        if permanent:
+            version = None
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop( key, None )
+            self._entries[key] = _CachedMarkup( markup, version, expires )
+            while len(self._entries) > self.size:
+                self._entries.popitem( last=False )
+
+
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
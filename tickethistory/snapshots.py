@@ -0,0 +1,289 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import datetime as dt
+import heapq
+
+from trac.core import Component, implements
+from trac.config import BoolOption
+from trac.env import IEnvironmentSetupParticipant
+from trac.db.api import DatabaseManager
+from trac.db.schema import Table, Column, Index
+from trac.ticket.api import ITicketChangeListener, TicketSystem
+from trac.util.datefmt import from_utimestamp as from_timestamp, to_datetime, \
+        to_utimestamp as to_timestamp
+from tickethistory import ticket_timetable as history
+
+
+SCHEMA_VERSION = 1
+
+# The state of a ticket at the end of every day on which the ticket was
+# created or one of the tracked fields changed.  The day is the ISO date in
+# the local timezone of the server.
+schema = [
+    Table('tickethistory_snapshot', key=('ticket', 'day'))[
+        Column('ticket', type='int'),
+        Column('day'),
+        Column('status'),
+        Column('milestone'),
+        Column('estimate'),
+        Index(['day'])]
+]
+
+# The rows in the system table.  The snapshots are used only after the
+# backfill stored the name of the estimation field.
+_version_name = 'tickethistory_snapshot_version'
+_backfill_name = 'tickethistory_snapshot_field'
+
+
+def _dayOf( time ):
+    return to_datetime( time ).date().isoformat()
+
+def _endOfDay( day ):
+    date = dt.datetime.strptime( day, "%Y-%m-%d" )
+    return to_datetime( dt.datetime.combine( date.date(), dt.time.max ) )
+
+
+class TicketSnapshots(Component):
+    """
+    Maintain the table of the daily ticket states used by the burn-down
+    table.
+
+    The table is optional.  It is created with a new environment or by the
+    command 'trac-admin <env> tickethistory snapshot' that also copies the
+    existing history to the table.  Once the table exists, it is kept up to
+    date by the ticket change listener.
+    """
+    implements(IEnvironmentSetupParticipant, ITicketChangeListener)
+
+    enabled = BoolOption('tickethistory', 'snapshots', 'true',
+            """Build the burn-down tables from the daily snapshots of the
+            tickets instead of the ticket changes when the snapshots are
+            available.""")
+
+    # The number of tickets that are rebuilt at once.
+    rebuildChunkSize = 500
+
+    def __init__(self):
+        self.tt_config = history.TimetableConfig()
+        self.fields = set( [ 'status', 'milestone', self.tt_config.estimation_field ] )
+        self._installed = False
+
+
+    # IEnvironmentSetupParticipant methods
+
+    def environment_created(self):
+        with self.env.db_transaction as db:
+            self.upgrade_environment( db )
+
+
+    # Only an installed table with an older schema needs an upgrade.
+    def environment_needs_upgrade(self, db):
+        version = self._getSystemValue( db, _version_name )
+        return version is not None and version != str( SCHEMA_VERSION )
+
+
+    # Create the tables that do not exist yet.
+    def upgrade_environment(self, db):
+        connector, _ = DatabaseManager(self.env).get_connector()
+        existing = set( db.get_table_names() )
+        cursor = db.cursor()
+        for table in schema:
+            if table.name in existing:
+                continue
+            for sql in connector.to_sql( table ):
+                cursor.execute( sql )
+        self._setSystemValue( db, _version_name, str( SCHEMA_VERSION ) )
+        self._installed = False
+
+
+    # Create the table of the snapshots if it is not installed.
+    def install( self ):
+        if not self.installed:
+            with self.env.db_transaction as db:
+                self.upgrade_environment( db )
+
+
+    def _getSystemValue( self, db, name ):
+        cursor = db.cursor()
+        cursor.execute( "SELECT value FROM system WHERE name=%s", ( name, ) )
+        for row in cursor:
+            return row[0]
+        return None
+
+
+    def _setSystemValue( self, db, name, value ):
+        cursor = db.cursor()
+        cursor.execute( "DELETE FROM system WHERE name=%s", ( name, ) )
+        if value is not None:
+            cursor.execute( "INSERT INTO system (name, value) VALUES (%s, %s)", ( name, value ) )
+
+
+    # True if the table is installed.  Only the positive result is cached; a
+    # missing table is looked up on every call because trac-admin may create
+    # it in another process at any time and no snapshot may be skipped.
+    @property
+    def installed( self ):
+        if self._installed:
+            return True
+        with self.env.db_query as db:
+            self._installed = self._getSystemValue( db, _version_name ) == str( SCHEMA_VERSION )
+        return self._installed
+
+
+    # True if the snapshots were backfilled for the current estimation field.
+    @property
+    def available( self ):
+        if not self.enabled or not self.installed:
+            return False
+        with self.env.db_query as db:
+            return self._getSystemValue( db, _backfill_name ) == self.tt_config.estimation_field
+
+
+    # True if the snapshots contain all the @p fields.
+    def covers( self, fields ):
+        return set( fields ) <= self.fields
+
+
+    # Generate the snapshots of the tickets with @p ticketIds up to the day of
+    # @p endTime as change rows (ticket, field, time, oldvalue, newvalue)
+    # ordered by time.  The time of a row is the timestamp of the end of its
+    # day.
+    def iterChangeRows( self, ticketIds, endTime ):
+        ids = sorted( set( ticketIds ) )
+        lastDay = _dayOf( endTime )
+        names = [ 'status', 'milestone', self.tt_config.estimation_field ]
+        with self.env.db_query as db:
+            def chunkRows( chunk ):
+                cursor = db.cursor()
+                cursor.execute( "SELECT day, ticket, status, milestone, estimate "
+                        "FROM tickethistory_snapshot WHERE ticket IN (%s) AND day <= %%s "
+                        "ORDER BY day, ticket" % ", ".join( ["%s"] * len(chunk) ), chunk + [lastDay] )
+                for row in cursor:
+                    yield row
+            sources = [ chunkRows( chunk ) for chunk in history._chunks( ids, history.HistoryBuilder.historyChunkSize ) ]
+            endTimes = {}
+            for row in heapq.merge( *sources ):
+                day, tid = row[0], row[1]
+                if day not in endTimes:
+                    endTimes[day] = to_timestamp( _endOfDay( day ) )
+                for name, value in zip( names, row[2:] ):
+                    yield ( tid, name, endTimes[day], None, value )
+
+
+    # Rebuild the snapshots of the tickets with @p ticketIds, or of all the
+    # tickets, from the ticket changes.  Returns the number of stored rows.
+    def rebuild( self, ticketIds=None ):
+        with self.env.db_query as db:
+            if ticketIds is None:
+                cursor = db.cursor()
+                cursor.execute( "SELECT id FROM ticket ORDER BY id" )
+                ticketIds = [ row[0] for row in cursor ]
+        count = 0
+        for chunk in history._chunks( sorted( set( ticketIds ) ), self.rebuildChunkSize ):
+            tickets = self._loadTickets( chunk )
+            rows = self._snapshotsFromHistory( tickets )
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                cursor.execute( "DELETE FROM tickethistory_snapshot WHERE ticket IN (%s)" %
+                        ", ".join( ["%s"] * len(chunk) ), chunk )
+                cursor.executemany( "INSERT INTO tickethistory_snapshot "
+                        "(ticket, day, status, milestone, estimate) VALUES (%s, %s, %s, %s, %s)", rows )
+            count += len(rows)
+        return count
+
+
+    # Create the table if needed, rebuild all the snapshots and mark them as
+    # available.
+    def backfill( self ):
+        self.install()
+        with self.env.db_transaction as db:
+            db( "DELETE FROM tickethistory_snapshot" )
+            self._setSystemValue( db, _backfill_name, None )
+        count = self.rebuild()
+        with self.env.db_transaction as db:
+            self._setSystemValue( db, _backfill_name, self.tt_config.estimation_field )
+        return count
+
+
+    # Load the tickets with the ids in @p chunk with the values of the
+    # tracked fields.
+    def _loadTickets( self, chunk ):
+        field = self.tt_config.estimation_field
+        custom = [ f for f in TicketSystem(self.env).get_custom_fields() if f['name'] == field ]
+        tickets = []
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            if len(custom) > 0:
+                cursor.execute( "SELECT t.id, t.time, t.status, t.milestone, c.value FROM ticket t "
+                        "LEFT OUTER JOIN ticket_custom c ON c.ticket = t.id AND c.name = %%s "
+                        "WHERE t.id IN (%s)" % ", ".join( ["%s"] * len(chunk) ), [field] + chunk )
+            else:
+                cursor.execute( "SELECT t.id, t.time, t.status, t.milestone, t.%s FROM ticket t "
+                        "WHERE t.id IN (%s)" % ( db.quote( field ), ", ".join( ["%s"] * len(chunk) ) ), chunk )
+            for tid, time, status, milestone, estimate in cursor:
+                tickets.append( { 'id': tid, 'time': from_timestamp( time ), 'status': status,
+                    'milestone': milestone, field: estimate } )
+        return tickets
+
+
+    # Replay the history of the @p tickets and return the rows with the state
+    # at the end of every day on which a tracked field changed.
+    def _snapshotsFromHistory( self, tickets ):
+        builder = history.HistoryBuilder( self.env, None )
+        builder.timestamp_to_datetime = lambda ts: from_timestamp( ts )
+        histories = builder._collectTicketHistories( tickets, builder._getHistorySettings( self.fields ) )
+        rows = []
+        for t in tickets:
+            ticketHistory = histories[t['id']]
+            state = {}
+            days = {}
+            for time in sorted( ticketHistory.keys() ):
+                state.update( ticketHistory[time] )
+                days[_dayOf( time )] = self._snapshotValues( state )
+            for day in sorted( days.keys() ):
+                rows.append( ( t['id'], day ) + days[day] )
+        return rows
+
+
+    def _snapshotValues( self, values ):
+        return ( values.get( 'status' ), values.get( 'milestone' ),
+                values.get( self.tt_config.estimation_field ) )
+
+
+    # Store the current state of the @p ticket as the state at the end of the
+    # day of @p time.
+    def _storeSnapshot( self, ticket, time ):
+        if not self.installed:
+            return
+        day = _dayOf( time )
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute( "DELETE FROM tickethistory_snapshot WHERE ticket=%s AND day=%s",
+                    ( ticket.id, day ) )
+            cursor.execute( "INSERT INTO tickethistory_snapshot "
+                    "(ticket, day, status, milestone, estimate) VALUES (%s, %s, %s, %s, %s)",
+                    ( ticket.id, day ) + self._snapshotValues( ticket.values ) )
+
+
+    # ITicketChangeListener methods
+
+    def ticket_created(self, ticket):
+        self._storeSnapshot( ticket, ticket['time'] )
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        if len( self.fields.intersection( old_values.keys() ) ) > 0:
+            self._storeSnapshot( ticket, ticket['changetime'] )
+
+    def ticket_deleted(self, ticket):
+        if self.installed:
+            with self.env.db_transaction as db:
+                db( "DELETE FROM tickethistory_snapshot WHERE ticket=%s", ( ticket.id, ) )
+
+    def ticket_comment_modified(self, ticket, cdate, author, comment, old_comment):
+        pass
+
+    def ticket_change_deleted(self, ticket, cdate, changes):
+        if self.installed:
+            self.rebuild( [ ticket.id ] )
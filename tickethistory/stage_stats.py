@@ -0,0 +1,100 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import time
+import contextlib
+
+from genshi.core import Markup, escape
+
+
+class StageStats:
+    """
+    The time spent in the stages of a macro and the counters of the processed
+    items (rows, tickets, entries, ...).
+
+    The stages can be nested.  The time of a stage does not include the time
+    of the stages entered from it, so the times add up to the total time.
+    The stages must be entered in the thread that created the object.
+    """
+    def __init__(self, name=""):
+        self.name = name
+        self.stages = [] # the names of the stages in the order of appearance
+        self.times = {}
+        self.counters = {}
+        self._stack = []
+        self._started = time.time()
+        self._mark = self._started
+
+
+    def _enter( self, name ):
+        now = time.time()
+        if len(self._stack) > 0:
+            self._addTime( self._stack[-1], now - self._mark )
+        self._stack.append( name )
+        self._mark = now
+
+
+    def _leave( self ):
+        now = time.time()
+        self._addTime( self._stack.pop(), now - self._mark )
+        self._mark = now
+
+
+    def _addTime( self, name, seconds ):
+        if name not in self.times:
+            self.stages.append( name )
+            self.times[name] = 0.0
+        self.times[name] += seconds
+
+
+    # Measure the time spent in a block:
+    #    with stats.stage( "render" ): ...
+    @contextlib.contextmanager
+    def stage( self, name ):
+        self._enter( name )
+        try:
+            yield
+        finally:
+            self._leave()
+
+
+    # Generate the items of @p iterable.  The time spent in producing the
+    # items is added to the stage @p name, the time of the consumer is not.
+    def iterate( self, name, iterable ):
+        items = iter( iterable )
+        while True:
+            self._enter( name )
+            try:
+                item = next( items )
+            except StopIteration:
+                return
+            finally:
+                self._leave()
+            yield item
+
+
+    def count( self, name, n=1 ):
+        self.counters[name] = self.counters.get( name, 0 ) + n
+
+
+    def elapsed( self ):
+        return time.time() - self._started
+
+
+    def summary( self ):
+        parts = [ "%s: total %.3fs" % ( self.name, self.elapsed() ) ]
+        parts += [ "%s %.3fs" % ( name, self.times[name] ) for name in self.stages ]
+        parts += [ "%s %d" % ( name, self.counters[name] ) for name in sorted( self.counters.keys() ) ]
+        return ", ".join( parts )
+
+
+    # Log the summary and return the @p markup of the macro.  The summary is
+    # appended to the markup as a hidden element if @p withFooter is set.
+    def finish( self, log, markup, withFooter=False ):
+        summary = self.summary()
+        log.debug( "StageStats %s", summary )
+        if not withFooter:
+            return markup
+        return markup + Markup( '<div class="tickethistory-timing" style="display:none">%s</div>'
+                % escape( summary ) )
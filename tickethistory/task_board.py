@@ -4,20 +4,23 @@
 
 import time
 import os
+import json
 import StringIO
 import math
+import re
 import traceback
 import datetime as dt
 
-from trac.core import implements, TracError
+from trac.core import Component, implements, TracError
+from trac.web.api import IRequestHandler, HTTPBadRequest
 from trac.wiki.macros import WikiMacroBase
 from trac.wiki import Formatter
 from trac.wiki.api import parse_args
 from trac.util.datefmt import from_utimestamp as from_timestamp, to_datetime, to_utimestamp as to_timestamp
 from trac.web.chrome import ITemplateProvider, Chrome, add_stylesheet, add_script, add_script_data
-from genshi.core import Markup
+from genshi.core import Markup, escape
 
-from tickethistory import options, dbutils, distributor
+from tickethistory import options, dbutils, distributor, history_cache, render_cache, worker_pool, stage_stats
 from tickethistory import ticket_timetable as history
 
 class ColumnInfo:
@@ -27,6 +30,26 @@ class ColumnInfo:
         self.columnClass = cssClass
 
 
+# Parse the column definitions of the task board from the macro option
+# `columns`: title:state;state|title:state|...  A column with the state `*`
+# receives the tickets with the states that are not listed.  The states are
+# separated by semicolons, spaces or commas; the commas split the arguments
+# of a macro call and must be escaped there with a backslash.
+def parseColumns( text ):
+    columns = []
+    for part in text.split( "|" ):
+        if len(part.strip()) == 0:
+            continue
+        if ":" not in part:
+            raise TracError( "Invalid board column '%s', expected title:state;state" % part )
+        title, states = part.split( ":", 1 )
+        states = [ s for s in re.split( "[;,\\s]+", states ) if len(s) > 0 ]
+        columns.append( ColumnInfo( title.strip(), "*" if states == [ "*" ] else states ) )
+    if len(columns) == 0:
+        raise TracError( "No board columns in '%s'" % text )
+    return columns
+
+
 class NoteFlag:
     def __init__(self, text=None, style=None ):
         self.text = text
@@ -164,6 +187,8 @@ class HtmlBoardRenderer:
         self.columns = columns
         self.flagProvider = None
         self.sortProvider = None
+        self.classProvider = None
+        self.notInProgress = set( timetableConfig.new_states ) | set( timetableConfig.closed_states )
         if self.columns is None:
             self.columns = [
                     ColumnInfo( "New", timetableConfig.new_states, "new_column" ),
@@ -178,6 +203,20 @@ class HtmlBoardRenderer:
                 if self.defaultColumn is None and col.states == "*":
                     self.defaultColumn = col
                 col.states = []
+        self._compileColumns()
+
+
+    # Map every state to the indices of the columns that show it.  The
+    # states that are not mapped go to the default column.
+    def _compileColumns( self ):
+        self.columnsByStatus = {}
+        for ic, col in enumerate(self.columns):
+            for state in col.states:
+                indices = self.columnsByStatus.setdefault( state, [] )
+                if ic not in indices:
+                    indices.append( ic )
+        try: self.defaultColumns = [ self.columns.index( self.defaultColumn ) ]
+        except ValueError: self.defaultColumns = []
 
 
     def setFlagProvider( self, flagProvider ):
@@ -194,16 +233,11 @@ class HtmlBoardRenderer:
 
     def splitTicketsIntoColumns( self, tickets ):
         res = [ [] for c in self.columns ]
-        try: idefault = self.columns.index( self.defaultColumn )
-        except ValueError: idefault = -1
+        columnsByStatus = self.columnsByStatus
+        defaultColumns = self.defaultColumns
         for t in tickets:
-            found = False
-            for ic,column in enumerate(self.columns):
-                if t.status in column.states:
-                    res[ic].append(t)
-                    found = True
-            if not found and idefault >= 0:
-                res[idefault].append( t )
+            for ic in columnsByStatus.get( t.status, defaultColumns ):
+                res[ic].append( t )
         return res
 
 
@@ -227,52 +261,63 @@ class HtmlBoardRenderer:
                 result.append( '''<div class="flag%s">%s</div>''' % (style, text) )
             result.append( '</div>' )
 
-    def render( self, tickets, env, formatter ):
+    # Render the note of the ticket @p t.  The note box is marked with the
+    # ticket id so that it can be replaced by the board updates.
+    def renderNote( self, t ):
+        nameLink = HtmlBoardRenderer._ticketIdAddr( t )
+        estimate = t.value_or(self.tt_config.estimation_field, "")
+        if estimate != "": estimate = "(%s)" % estimate
+        isInProgress = t.value_or( "status", "" ) not in self.notInProgress
+        owner = t.value_or( "owner", "" ) if isInProgress else ""
+        summary = t.value_or( "summary", "" )
+
+        noteClass = ""
+        if self.classProvider is not None:
+            noteClass = " ".join( self.classProvider.getClasses( t ) )
+
+        result = [ '''<div class="note-box" data-ticket="%d">''' % t.tid() ]
+        noteContent = '''
+          <div class="note %s">
+          <span class="note-head">
+            <span class="ticket">%s</span>
+            <span class="estimate">%s</span>
+            <span class="owner">%s</span>
+          </span>
+          &nbsp;%s
+          </div>''' % ( noteClass, nameLink, estimate, owner, summary )
+        result.append( noteContent )
+
+        if self.flagProvider is not None:
+            self._renderFlags( t, result )
+        result.append( '</div>' ) # note-box
+        return "\n".join( result )
+
+
+    # @p updates - ( url, since ) of the board updates for a live board: the
+    #    notes of the tickets that changed after the timestamp since are
+    #    retrieved from the url by htdocs/js/taskboard.js
+    def render( self, tickets, env, formatter, updates=None ):
         add_stylesheet(formatter.req, 'tickethistory/css/tickethistory.css')
 
-        def isInProgress( ticketInfo ):
-            ttc = self.tt_config
-            status = ticketInfo.value_or( "status", "" )
-            return status not in ttc.new_states and status not in ttc.closed_states
-
         columns = self.splitTicketsIntoColumns( tickets )
         sizes = self.calculateColumnSizes( columns )
 
-        result = ['<div class="tickethist-board">']
+        if updates is None:
+            result = ['<div class="tickethist-board">']
+        else:
+            add_script(formatter.req, 'tickethistory/js/taskboard.js')
+            result = ['<div class="tickethist-board" data-updates="%s" data-since="%d">' % (
+                escape( updates[0] ), updates[1] )]
         for ic,colTickets in enumerate(columns):
             if self.sortProvider is not None:
                 self.sortProvider.sortTicketInfos( colTickets )
 
             colInfo = self.columns[ic]
             result.append( '<div class="col-%d column %s">' % ( sizes[ic], colInfo.columnClass ) )
-            result.append( '<h2 class="column-title">%s</h2>' % colInfo.title )
+            result.append( '<h2 class="column-title">%s</h2>' % escape( colInfo.title ) )
             result.append( '<div class="column-content">' )
             for t in colTickets:
-                nameLink = HtmlBoardRenderer._ticketIdAddr( t )
-                estimate = t.value_or(self.tt_config.estimation_field, "")
-                if estimate != "": estimate = "(%s)" % estimate
-                owner = t.value_or( "owner", "" ) if isInProgress( t ) else ""
-                summary = t.value_or( "summary", "" )
-
-                noteClass = ""
-                if self.classProvider is not None:
-                    noteClass = " ".join( self.classProvider.getClasses( t ) )
-
-                result.append( '''<div class="note-box">''' )
-                noteContent = '''
-                  <div class="note %s">
-                  <span class="note-head">
-                    <span class="ticket">%s</span>
-                    <span class="estimate">%s</span>
-                    <span class="owner">%s</span>
-                  </span>
-                  &nbsp;%s
-                  </div>''' % ( noteClass, nameLink, estimate, owner, summary )
-                result.append( noteContent )
-
-                if self.flagProvider is not None:
-                    self._renderFlags( t, result )
-                result.append( '</div>' ) # note-box
+                result.append( self.renderNote( t ) )
 
             result.append( '</div>' ) # column-content
             result.append( '</div>' ) # column
@@ -284,7 +329,39 @@ class HtmlBoardRenderer:
 
 class TaskBoardOptions(options.OptionRegistry):
     def __init__(self):
-        super(TaskBoardOptions, self).__init__([])
+        super(TaskBoardOptions, self).__init__(["date", "columns", "debug"])
+        self._overrides = None
+        self._positional = []
+
+
+    def get_parameter_sets(self):
+        return (self.iniParams, self.macroParams, self.urlParams, self._overrides)
+
+
+    def set_macro_params( self, params, useStrictParsing=False ):
+        super(TaskBoardOptions, self).set_macro_params( params, useStrictParsing )
+        if type(params) == type("") or type(params) == unicode:
+            for line in params.strip().split("\n"):
+                self._positional += parse_args( line.strip(), useStrictParsing )[0]
+
+
+    # An unescaped comma in the option `columns` splits the definition and
+    # leaves the rest of it as a positional argument.
+    def verify(self):
+        if len(self._positional) > 0 and 'columns' in self.options():
+            raise TracError( "Unexpected arguments '%s' after the option columns; "
+                    "separate the states with ';'" % ",".join( self._positional ) )
+
+
+    def apply_defaults(self):
+        self._overrides = {}
+        options = self.options()
+
+        def parse_date( datestr ):
+            return dt.datetime(*time.strptime(datestr, "%Y-%m-%d")[0:5]).date()
+
+        if "date" in options:
+            self._overrides["date"] = parse_date( options.get("date") )
 
 
 class TaskBoardMacro(WikiMacroBase):
@@ -309,27 +386,93 @@ class TaskBoardMacro(WikiMacroBase):
         optionReg = TaskBoardOptions()
         optionReg.set_macro_params(text)
         optionReg.set_url_params(request.args)
+        optionReg.apply_defaults()
         optionReg.verify()
         options = optionReg.options()
         query_args = optionReg.query_args()
 
-        flagProvider = NoteFlagProvider()
-        sortProvider = SortOrderProvider()
-        classProvider = NoteClassProvider();
-
-        desired_fields = [self.tt_config.estimation_field, "summary", "owner", "type"]
-        desired_fields = desired_fields + self.tt_config.iteration_fields
-        desired_fields = desired_fields + flagProvider.extra_fields
-        desired_fields = desired_fields + sortProvider.extra_fields
-        desired_fields = desired_fields + classProvider.extra_fields
+        # With debug=timing the stage times are added to the page.
+        stats = stage_stats.StageStats( name )
+        showTiming = options.pop( 'debug', None ) == 'timing'
+        retriever.stats = stats
+
+        # A board for a past date does not change any more.
+        cache = render_cache.MacroRenderCache(self.env)
+        if cache.enabled:
+            with stats.stage( "cache" ):
+                cacheKey = cache.makeKey( name, options, query_args, request.href(),
+                        request.authname if retriever.vieableOnly else None )
+                permanent = 'date' in options and options['date'] < dt.date.today()
+                version = None if permanent else retriever.get_milestone_data_version( query_args['milestone'] )
+                markup = cache.get( cacheKey, version )
+            if markup is not None:
+                stats.count( "cache_hits" )
+                add_stylesheet(request, 'tickethistory/css/tickethistory.css')
+                if 'date' not in options:
+                    add_script(request, 'tickethistory/js/taskboard.js')
+                return stats.finish( self.log, markup, showTiming )
+
+        markup = self._render( formatter, retriever, options, query_args, stats )
+        if cache.enabled:
+            cache.put( cacheKey, markup, version, permanent )
+        return stats.finish( self.log, markup, showTiming )
+
+
+    def _render(self, formatter, retriever, options, query_args, stats):
+        renderer = self._createRenderer( self.tt_config, options )
+        boardTickets, tickets = self._buildBoard( self.tt_config, retriever, options, query_args,
+                self._boardFields( self.tt_config, renderer ), stats )
+
+        # A live board is updated in place by htdocs/js/taskboard.js.
+        updates = None
+        if 'date' not in options:
+            args = dict( query_args )
+            if options.get('columns'):
+                args['columns'] = options['columns']
+            since = max( [0] + [ to_timestamp( t['changetime'] ) for t in tickets if t.get('changetime') ] )
+            updates = ( formatter.req.href( 'tickethistory', 'taskboard.json', **args ), since )
+
+        with stats.stage( "render" ):
+            return renderer.render( boardTickets, self.env, formatter, updates )
+
+
+    def _createRenderer(self, tt_config, options):
+        columns = parseColumns( options['columns'] ) if options.get('columns') else None
+        # renderer = DebugDumpRenderer( tt_config )
+        # renderer = TracMarkupBoardRenderer(tt_config)
+        renderer = HtmlBoardRenderer(tt_config, columns)
+        renderer.setFlagProvider( NoteFlagProvider() )
+        renderer.setSortProvider( SortOrderProvider() )
+        renderer.setNoteClassProvider( NoteClassProvider() )
+        return renderer
+
+
+    # The fields of the tickets that are shown by the @p renderer.
+    def _boardFields(self, tt_config, renderer):
+        desired_fields = [tt_config.estimation_field, "summary", "owner", "type"]
+        desired_fields = desired_fields + tt_config.iteration_fields
+        desired_fields = desired_fields + renderer.flagProvider.extra_fields
+        desired_fields = desired_fields + renderer.sortProvider.extra_fields
+        desired_fields = desired_fields + renderer.classProvider.extra_fields
+        return desired_fields
+
+
+    # Return the TicketInfos on the board and all the retrieved tickets.  If
+    # @p ticketIds is set, only the TicketInfos of those tickets are built.
+    def _buildBoard(self, tt_config, retriever, options, query_args, desired_fields, stats, ticketIds=None):
         # self.env.log.debug("TaskBoardMacro OPTIONS %s", options)
         # self.env.log.debug("TaskBoardMacro QUERY %s", query_args)
-
-        isInIteration = self.tt_config.getIsInIteration( query_args );
+        isInIteration = tt_config.getIsInIteration( query_args );
 
         builder = history.HistoryBuilder( self.env, isInIteration )
         builder.timestamp_to_datetime = lambda ts: from_timestamp( ts )
+        builder.datetime_to_timestamp = to_timestamp
+        historyCache = history_cache.TicketHistoryCache(self.env)
+        builder.historyCache = historyCache if historyCache.enabled else None
+        builder.workerPool = worker_pool.HistoryWorkerPool(self.env)
+        builder.stats = stats
         tickets = retriever.retrieve( query_args, desired_fields )
+        stats.count( "tickets", len(tickets) )
         # self.env.log.debug("TaskBoardMacro TICKETS in milestone: %s", [t['id'] for t in tickets])
         if 'date' in options:
             board_time = to_datetime(dt.datetime.combine(options['date'], dt.time.max))
@@ -339,12 +482,66 @@ class TaskBoardMacro(WikiMacroBase):
         board_entry = history.TimetableEntry( board_time )
         timetable = history.Timetable( start )
         timetable.entries = [ board_entry ]
-        builder.fillTicketTimetable(tickets, timetable, desired_fields )
-
-        # renderer = DebugDumpRenderer( self.tt_config )
-        # renderer = TracMarkupBoardRenderer(self.tt_config)
-        renderer = HtmlBoardRenderer(self.tt_config)
-        renderer.setFlagProvider( flagProvider )
-        renderer.setSortProvider( sortProvider )
-        renderer.setNoteClassProvider( classProvider )
-        return renderer.render( board_entry.tickets, self.env, formatter )
+        selected = tickets
+        if ticketIds is not None:
+            ticketIds = set( ticketIds )
+            selected = [ t for t in tickets if t['id'] in ticketIds ]
+        builder.fillTicketTimetable(selected, timetable, desired_fields )
+        return board_entry.tickets, tickets
+
+
+class TaskBoardUpdateHandler(Component):
+    """
+    Return the notes of the tickets on a live TaskBoard that changed after
+    the timestamp `since` as JSON.  The request takes the same arguments as
+    the TaskBoard macro.  The response is
+
+        { "since": latest changetime,
+          "tickets": [ { "id": id, "column": column index, "html": note } ],
+          "removed": [ ids of the changed tickets that left the board ] }
+
+    Only the tickets that were at any time part of the milestone are
+    checked.  When none of them changed, only a single query is executed (see
+    'trac-admin <env> tickethistory index').
+    """
+    implements(IRequestHandler)
+
+    def match_request(self, req):
+        return req.path_info == '/tickethistory/taskboard.json'
+
+
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW')
+        args = dict( req.args )
+        try: since = int( args.pop( 'since', 0 ) )
+        except ValueError: raise HTTPBadRequest( "Invalid timestamp 'since'" )
+
+        optionReg = TaskBoardOptions()
+        optionReg.set_url_params( args )
+        optionReg.apply_defaults()
+        optionReg.verify()
+        options = optionReg.options()
+        query_args = optionReg.query_args()
+        if 'milestone' not in query_args:
+            raise HTTPBadRequest( "No milestone specified" )
+
+        retriever = dbutils.MilestoneRetriever( self.env, req )
+        changes = {}
+        if 'date' not in options:
+            changes = retriever.get_changed_tickets_in_milestone( query_args['milestone'], since )
+
+        data = { 'since': max( [since] + changes.values() ), 'tickets': [], 'removed': [] }
+        if len(changes) > 0:
+            tt_config = history.TimetableConfig()
+            macro = TaskBoardMacro(self.env)
+            renderer = macro._createRenderer( tt_config, options )
+            boardTickets, tickets = macro._buildBoard( tt_config, retriever, options, query_args,
+                    macro._boardFields( tt_config, renderer ), retriever.stats, changes.keys() )
+            onBoard = set()
+            for ic, column in enumerate( renderer.splitTicketsIntoColumns( boardTickets ) ):
+                for t in column:
+                    data['tickets'].append( { 'id': t.tid(), 'column': ic, 'html': renderer.renderNote( t ) } )
+                    onBoard.add( t.tid() )
+            data['removed'] = sorted( t['id'] for t in tickets if t['id'] in changes and t['id'] not in onBoard )
+
+        req.send( json.dumps( data ), 'application/json' )
@@ -0,0 +1,126 @@
+from ..burn_down_table import *
+from .. import dbutils
+from .synthenv import *
+from trac.test import MockRequest
+from trac.ticket.model import Ticket
+from trac.web.api import RequestDone, HTTPBadRequest
+from datetime import datetime, timedelta
+import json
+import traceback
+
+tests=[]
+def test( fn ):
+    tests.append(fn)
+    return fn
+
+def runTests():
+    for t in tests:
+        print t
+        try: t()
+        except Exception as e:
+            print e
+            traceback.print_exc()
+        print
+
+_env = None
+def getEnvironment():
+    global _env
+    if _env is None:
+        _env = createEnvironment( SyntheticEnvSettings( tickets=60, milestones=3, days=40 ) )
+    return _env
+
+_args = { 'milestone': 'sprint1', 'startdate': '2017-01-02', 'enddate': '2017-01-31', 'today': '2017-02-03' }
+
+# Return ( status code, response headers, body ) of a request to
+# /tickethistory/burndown.<format>.
+def requestData( env, format, args=_args, headers={} ):
+    req = MockRequest( env, path_info='/tickethistory/burndown.' + format, args=dict( args ) )
+    inheaders = dict( ( k.lower(), v ) for k, v in headers.iteritems() )
+    req.get_header = lambda name: inheaders.get( name.lower() )
+    handler = BurnDownDataHandler( env )
+    if not handler.match_request( req ):
+        raise Exception( "Request not matched" )
+    try: handler.process_request( req )
+    except RequestDone: pass
+    return int( req.status_sent[0].split()[0] ), req.headers_sent, req.response_sent.getvalue()
+
+@test
+def shouldExportTheSameRowsAsJsonAndCsv():
+    env = getEnvironment()
+    status, headers, body = requestData( env, 'json' )
+    if status != 200 or headers['Content-Type'] != 'application/json':
+        raise Exception( "Unexpected response %s %s" % ( status, headers ) )
+    data = json.loads( body )
+    status, headers, body = requestData( env, 'csv' )
+    if status != 200 or not headers['Content-Type'].startswith( 'text/csv' ):
+        raise Exception( "Unexpected response %s %s" % ( status, headers ) )
+    lines = body.splitlines()
+    columns = BurnDownDataHandler.columns
+    if lines[0] != ",".join( columns ):
+        raise Exception( "Unexpected header %s" % lines[0] )
+    # 30 days of the iteration and today after the end of the iteration
+    if len(data['days']) != 31 or len(lines) != 32 or data['days'][-1]['date'] != '2017-02-03':
+        raise Exception( "Unexpected number of rows %d %d" % ( len(data['days']), len(lines) ) )
+    for day, line in zip( data['days'], lines[1:] ):
+        values = [ "" if day[c] is None else str( day[c] ) for c in columns ]
+        if ",".join( values ) != line:
+            raise Exception( "Different rows %s %s" % ( values, line ) )
+    print data['days'][0], "ok"
+
+@test
+def shouldAnswerNotModifiedWithoutRetrievingTheTickets():
+    env = getEnvironment()
+    status, headers, body = requestData( env, 'json' )
+    etag, lastModified = headers['ETag'], headers['Last-Modified']
+    later = http_date( datetime( 2030, 1, 1, tzinfo=utc ) )
+
+    retrieve = dbutils.MilestoneRetriever.retrieve
+    def failingRetrieve( *args ):
+        raise Exception( "The tickets were retrieved" )
+    dbutils.MilestoneRetriever.retrieve = failingRetrieve
+    try:
+        for headers in [ { 'If-None-Match': etag }, { 'If-Modified-Since': lastModified },
+                { 'If-Modified-Since': later } ]:
+            status, _, body = requestData( env, 'json', headers=headers )
+            if status != 304 or body != "":
+                raise Exception( "Expected 304 for %s, got %s" % ( headers, status ) )
+    finally:
+        dbutils.MilestoneRetriever.retrieve = retrieve
+
+    # The ETag depends on the format.
+    status, _, _ = requestData( env, 'csv', headers={ 'If-None-Match': etag } )
+    if status != 200:
+        raise Exception( "Expected 200 for another format, got %s" % status )
+
+    env.config.set( 'tickethistory', 'holidays', '2017-01-16' )
+    try:
+        status, headers, _ = requestData( env, 'json', headers={ 'If-None-Match': etag } )
+    finally:
+        env.config.set( 'tickethistory', 'holidays', '' )
+    if status != 200 or headers['ETag'] == etag:
+        raise Exception( "Expected a new ETag after a holiday change, got %s" % status )
+
+    tid = env.db_query( "SELECT MIN(id) FROM ticket WHERE milestone='sprint1'" )[0][0]
+    ticket = Ticket( env, tid )
+    ticket['summary'] = "Changed"
+    ticket.save_changes( "somebody", "" )
+    for headers in [ { 'If-None-Match': etag }, { 'If-Modified-Since': lastModified } ]:
+        status, _, _ = requestData( env, 'json', headers=headers )
+        if status != 200:
+            raise Exception( "Expected 200 after a change for %s, got %s" % ( headers, status ) )
+    print "ok"
+
+@test
+def shouldRejectInvalidArguments():
+    env = getEnvironment()
+    for args in [ { 'startdate': '2017-01-02' }, { 'milestone': 'sprint1' },
+            { 'milestone': 'sprint1', 'startdate': '2017-13-45' } ]:
+        try:
+            requestData( env, 'csv', args )
+        except HTTPBadRequest as e:
+            print args, e
+            continue
+        raise Exception( "Expected HTTPBadRequest for %s" % args )
+    print "ok"
+
+runTests()
@@ -1,4 +1,11 @@
 from ..iterationinfo import *
+from .. import iterationinfo, dbutils
+from ..iteration_overview import IterationOverviewMacro
+from .synthenv import *
+from trac.test import EnvironmentStub, MockRequest
+from trac.web.chrome import web_context
+from trac.wiki.formatter import Formatter
+import re
 import traceback
 
 tests=[]
@@ -32,4 +39,112 @@ SprintTwo,2017-06-26,2017-06-30
     if iterations[1].name != "SprintTwo":
         raise Exception( "Expected SprintTwo" )
 
+@test
+def shouldFindIterationsByDate():
+    iterations = [ IterationInfo( "Release", "2017-06-01", "2017-07-31" ),
+            IterationInfo( "SprintTwo", "2017-06-26", "2017-06-30" ),
+            IterationInfo( "SprintOne", "2017-06-19", "2017-06-23" ) ]
+    index = IterationIndex( iterations )
+    def test( datestr, expected ):
+        date = dt.datetime.strptime( datestr, "%Y-%m-%d" ).date()
+        names = [ i.name for i in index.getIterationsByDate( date ) ]
+        if names != expected:
+            raise Exception( "Wrong iterations for %s: %s, exp: %s" % ( datestr, names, expected ) )
+        print datestr, names, "ok"
+
+    test( "2017-05-31", [] )
+    test( "2017-06-01", [ "Release" ] )
+    test( "2017-06-19", [ "Release", "SprintOne" ] )
+    test( "2017-06-24", [ "Release" ] )
+    test( "2017-06-30", [ "Release", "SprintTwo" ] )
+    test( "2017-08-01", [] )
+    if index.byName["SprintTwo"] is not iterations[1]:
+        raise Exception( "Expected SprintTwo" )
+
+@test
+def shouldReadTheWikiPageOnlyWhenItChanged():
+    env = EnvironmentStub( default_data=True )
+    iterationinfo._parsedPages.clear()
+    def savePage( text ):
+        page = WikiPage( env, "Sprints" )
+        page.text = "{{{\nname,startdate,enddate\n%s\n}}}" % text
+        page.save( "somebody", "", "127.0.0.1" )
+    savePage( "SprintOne,2017-06-19,2017-06-23" )
+
+    checks = []
+    reads = []
+    getVersion = IterationInfoWikiTable.getVersion
+    def countingGetVersion( self ):
+        checks.append( self.wikiPage )
+        return getVersion( self )
+    def countingWikiPage( env, name, version=None ):
+        reads.append( version )
+        return WikiPage( env, name, version )
+    IterationInfoWikiTable.getVersion = countingGetVersion
+    iterationinfo.WikiPage = countingWikiPage
+    try:
+        table = IterationInfoWikiTable( env, "Sprints" )
+        table.getIterationList()
+        table.getIterationByName( "SprintOne" )
+        table.getIterationsByDate( dt.date( 2017, 6, 20 ) )
+        IterationInfoWikiTable( env, "Sprints" ).getIterationList()
+        if len(checks) != 2 or reads != [ 1 ]:
+            raise Exception( "Expected 2 checks and 1 read, got %d, %s" % ( len(checks), reads ) )
+
+        savePage( "SprintOne,2017-06-19,2017-06-23\nSprintTwo,2017-06-26,2017-06-30" )
+        if len(table.getIterationList()) != 1:
+            raise Exception( "Expected the iterations of the first check" )
+        names = [ i.name for i in IterationInfoWikiTable( env, "Sprints" ).getIterationList() ]
+        if names != [ "SprintOne", "SprintTwo" ] or reads != [ 1, 2 ]:
+            raise Exception( "Wrong iterations after the change: %s, reads %s" % ( names, reads ) )
+        print len(checks), reads, names, "ok"
+    finally:
+        IterationInfoWikiTable.getVersion = getVersion
+        iterationinfo.WikiPage = WikiPage
+
+def overviewRows( env, args ):
+    formatter = Formatter( env, web_context( MockRequest( env ), "wiki", "WikiStart" ) )
+    html = unicode( IterationOverviewMacro( env ).expand_macro( formatter, "IterationOverview", args, None ) )
+    rows = []
+    for row in re.findall( "<tr>(.*?)</tr>", html )[1:]:
+        cells = re.findall( "<td[^>]*>(.*?)</td>", row )
+        rows.append( [ re.sub( "<[^>]*>", "", cells[0] ) ] + cells[1:6] )
+    return rows
+
+@test
+def shouldShowTheOverviewRowsOfAllIterations():
+    env = createEnvironment( SyntheticEnvSettings( tickets=60, milestones=3, days=42 ) )
+    env.config.set( "tickethistory", "render_cache_size", "0" )
+    iterationinfo._parsedPages.clear()
+    page = WikiPage( env, "Sprints" )
+    page.text = """{{{
+name,startdate,enddate
+sprint1,2017-01-02,2017-01-13
+sprint2,2017-01-16,2017-01-27
+sprint3,2017-01-30,2017-02-10
+}}}"""
+    page.save( "somebody", "", "127.0.0.1" )
+
+    calls = []
+    retrieveMilestones = dbutils.MilestoneRetriever.retrieve_milestones
+    def countingRetrieve( self, milestones, query_args, extra_columns=None ):
+        calls.append( list( milestones ) )
+        return retrieveMilestones( self, milestones, query_args, extra_columns )
+    dbutils.MilestoneRetriever.retrieve_milestones = countingRetrieve
+    try:
+        rows = overviewRows( env, "table=Sprints,today=2017-01-20" )
+    finally:
+        dbutils.MilestoneRetriever.retrieve_milestones = retrieveMilestones
+    if calls != [ [ "sprint1", "sprint2", "sprint3" ] ]:
+        raise Exception( "Expected a single retrieval, got %s" % calls )
+    if [ r[0] for r in rows ] != [ "sprint1", "sprint2", "sprint3" ]:
+        raise Exception( "Wrong iterations %s" % [ r[0] for r in rows ] )
+
+    # Every row equals the row of the iteration shown alone.
+    for row in rows:
+        alone = overviewRows( env, "table=Sprints,today=2017-01-20,iterations=%s" % row[0] )
+        if alone != [ row ]:
+            raise Exception( "Wrong row %s, exp: %s" % ( row, alone ) )
+        print row, "ok"
+
 runTests()
@@ -0,0 +1,125 @@
+from .. import dbutils, ticket_timetable as history
+from ..burn_down_table import BurnDownTableMacro, createHistoryBuilder
+from ..task_board import TaskBoardMacro
+from .synthenv import *
+from trac.test import MockRequest
+from trac.web.chrome import web_context
+from trac.wiki.formatter import Formatter
+from datetime import timedelta
+import json
+import optparse
+import platform
+import sys
+import time
+
+# Time the hot paths of the macros on a synthetic Trac environment and report
+# the results as JSON.  The render cache is disabled so that every run of a
+# macro renders the table.  The macros are timed without the history cache
+# (cold) and with a primed history cache (warm).
+#
+#   python -B -m tickethistory.test.macro_bench [options]
+#
+# Use --database to keep the environment in an SQLite file instead of memory.
+
+def timeIt( fn, repeat ):
+    runs = []
+    for i in xrange( repeat ):
+        started = time.time()
+        fn()
+        runs.append( time.time() - started )
+    return { "best": min( runs ), "mean": sum( runs ) / len( runs ), "runs": len( runs ) }
+
+def makeTimetable( start, days ):
+    timetable = history.Timetable( start )
+    timetable.entries = [ history.TimetableEntry( start + timedelta( days=d, hours=23 ) ) for d in xrange( days ) ]
+    timetable.sort()
+    return timetable
+
+def makeFormatter( env ):
+    request = MockRequest( env )
+    return Formatter( env, web_context( request, "wiki", "WikiStart" ) )
+
+def runBenchmark( settings, repeat ):
+    started = time.time()
+    env = createEnvironment( settings )
+    env.config.set( "tickethistory", "render_cache_size", "0" )
+    setup = time.time() - started
+    changes = env.db_query( "SELECT COUNT(*) FROM ticket_change" )[0][0]
+
+    milestone = settings.milestoneNames()[0]
+    tt_config = history.TimetableConfig()
+    fields = [ tt_config.estimation_field ] + tt_config.iteration_fields
+    startdate = settings.start.date()
+    enddate = settings.endTime().date()
+    today = startdate + timedelta( days=settings.days / 2 )
+    burnDownArgs = "milestone=%s,startdate=%s,enddate=%s,today=%s" % ( milestone, startdate, enddate, today )
+    taskBoardArgs = "milestone=%s,date=%s" % ( milestone, today )
+
+    def retrieve():
+        return dbutils.MilestoneRetriever( env, MockRequest( env ) ).retrieve( { "milestone": milestone }, fields )
+
+    tickets = retrieve()
+
+    def fillTimetable():
+        builder = createHistoryBuilder( env, tt_config.getIsInIteration( { "milestone": milestone } ) )
+        builder.fillTicketTimetable( tickets, makeTimetable( settings.start, settings.days ),
+                [ tt_config.estimation_field ] )
+
+    def burnDownTable():
+        BurnDownTableMacro( env ).expand_macro( makeFormatter( env ), "BurnDownTable", burnDownArgs, None )
+
+    def taskBoard():
+        TaskBoardMacro( env ).expand_macro( makeFormatter( env ), "TaskBoard", taskBoardArgs, None )
+
+    results = {}
+    env.config.set( "tickethistory", "history_cache", "false" )
+    results["retrieve"] = timeIt( retrieve, repeat )
+    results["fill_timetable"] = timeIt( fillTimetable, repeat )
+    results["burn_down_table_cold"] = timeIt( burnDownTable, repeat )
+    results["task_board_cold"] = timeIt( taskBoard, repeat )
+    env.config.set( "tickethistory", "history_cache", "true" )
+    burnDownTable()
+    results["burn_down_table_warm"] = timeIt( burnDownTable, repeat )
+    results["task_board_warm"] = timeIt( taskBoard, repeat )
+
+    return {
+        "settings": {
+            "tickets": settings.tickets,
+            "changes_per_ticket": settings.changesPerTicket,
+            "milestones": settings.milestones,
+            "days": settings.days,
+            "seed": settings.seed,
+            "database": settings.database or ":memory:",
+        },
+        "environment": {
+            "ticket_change_rows": changes,
+            "milestone_tickets": len( tickets ),
+            "setup_seconds": setup,
+            "python": platform.python_version(),
+        },
+        "started": time.strftime( "%Y-%m-%dT%H:%M:%S", time.localtime( started ) ),
+        "results": results,
+    }
+
+def main( argv ):
+    parser = optparse.OptionParser( usage="python -B -m tickethistory.test.macro_bench [options]" )
+    parser.add_option( "--tickets", type="int", default=2000 )
+    parser.add_option( "--changes", type="int", default=10, help="average changes per ticket" )
+    parser.add_option( "--milestones", type="int", default=5 )
+    parser.add_option( "--days", type="int", default=90 )
+    parser.add_option( "--seed", type="int", default=1 )
+    parser.add_option( "--database", default=None, help="SQLite file; in memory if not set" )
+    parser.add_option( "--repeat", type="int", default=3 )
+    parser.add_option( "--output", default=None, help="write the JSON to a file instead of stdout" )
+    opts, args = parser.parse_args( argv )
+
+    settings = SyntheticEnvSettings( tickets=opts.tickets, changesPerTicket=opts.changes,
+            milestones=opts.milestones, days=opts.days, seed=opts.seed, database=opts.database )
+    report = json.dumps( runBenchmark( settings, max( 1, opts.repeat ) ), indent=2, sort_keys=True )
+    if opts.output:
+        with open( opts.output, "w" ) as f:
+            f.write( report + "\n" )
+    else:
+        print report
+
+main( sys.argv[1:] )
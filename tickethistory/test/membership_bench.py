@@ -0,0 +1,50 @@
+from .. import dbutils, admin
+from .synthenv import *
+import sys
+import time
+
+# Time the lookup of the tickets that were at any time part of a milestone.
+# The OR query over a LEFT JOIN is compared with the UNION query, without and
+# with the optional indexes on ticket_change.
+#
+#   python -B -m tickethistory.test.membership_bench [tickets changesPerTicket]
+
+_or_sql = ( "SELECT "
+        "DISTINCT t.id "
+        "FROM ticket t LEFT JOIN ticket_change c "
+        "ON c.ticket = t.id "
+        "  WHERE (t.milestone=%s OR (field='milestone' AND (c.oldvalue=%s OR c.newvalue=%s) ) )" )
+
+def timeQuery( env, sql, milestones, repeat=3 ):
+    best = None
+    count = 0
+    for i in xrange( repeat ):
+        started = time.time()
+        for m in milestones:
+            count = len( env.db_query( sql, [m, m, m] ) )
+        elapsed = time.time() - started
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+def runBenchmark( tickets, changesPerTicket ):
+    settings = SyntheticEnvSettings( tickets=tickets, changesPerTicket=changesPerTicket, milestones=12 )
+    env = createEnvironment( settings )
+    changes = env.db_query( "SELECT COUNT(*) FROM ticket_change" )[0][0]
+    milestones = settings.milestoneNames()
+    print "tickets %d, ticket_change rows %d, milestones %d" % ( tickets, changes, len(milestones) )
+
+    orIds = sorted( r[0] for r in env.db_query( _or_sql, [milestones[0]] * 3 ) )
+    unionIds = sorted( r[0] for r in env.db_query( dbutils._milestone_ticket_ids_sql, [milestones[0]] * 3 ) )
+    if orIds != unionIds:
+        raise Exception( "The queries return different tickets" )
+
+    print "  OR/LEFT JOIN, no index: %.3fs" % timeQuery( env, _or_sql, milestones )
+    print "  UNION,        no index: %.3fs" % timeQuery( env, dbutils._milestone_ticket_ids_sql, milestones )
+    admin.create_indexes( env, admin.ticket_change_indexes )
+    print "  OR/LEFT JOIN, indexes:  %.3fs" % timeQuery( env, _or_sql, milestones )
+    print "  UNION,        indexes:  %.3fs" % timeQuery( env, dbutils._milestone_ticket_ids_sql, milestones )
+
+if len(sys.argv) > 2:
+    runBenchmark( int(sys.argv[1]), int(sys.argv[2]) )
+else:
+    runBenchmark( 10000, 10 )
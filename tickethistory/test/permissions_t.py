@@ -0,0 +1,91 @@
+from ..dbutils import *
+from trac.core import Component, implements
+from trac.perm import IPermissionPolicy
+from trac.test import EnvironmentStub, MockRequest
+import traceback
+
+tests=[]
+def test( fn ):
+    tests.append(fn)
+    return fn
+
+def runTests():
+    for t in tests:
+        print t
+        try: t()
+        except Exception as e:
+            print e
+            traceback.print_exc()
+        print
+
+class DenyingPolicy(Component):
+    """Deny the tickets 2 and 4; the ticket 3 is viewable only with
+    TICKET_VIEW_CC."""
+    implements(IPermissionPolicy)
+
+    def check_permission(self, action, username, resource, perm):
+        if resource is None or resource.realm != 'ticket':
+            return None
+        if resource.id in ( 2, 4 ):
+            return False
+        if resource.id == 3:
+            return action == 'TICKET_VIEW_CC'
+        return None
+
+class CountingPerm:
+    def __init__( self, perm ):
+        self.perm = perm
+        self.calls = []
+
+    def __contains__( self, action ):
+        return action in self.perm
+
+    def __call__( self, realm, id ):
+        self.calls.append( id )
+        return self.perm( realm, id )
+
+def makeRetriever( env ):
+    req = MockRequest( env, authname='somebody' )
+    req.perm = CountingPerm( req.perm )
+    return Retriever( env, req )
+
+def makeTickets():
+    return [ { 'id': i } for i in xrange( 1, 6 ) ]
+
+@test
+def shouldSkipTheTicketChecksWithTheDefaultPolicies():
+    env = EnvironmentStub( default_data=True )
+    retriever = makeRetriever( env )
+    tickets = makeTickets()
+    if retriever.filter_viewable_tickets( tickets ) is not tickets:
+        raise Exception( "Expected the unfiltered tickets" )
+    if len(retriever.request.perm.calls) > 0 or 'hidden_tickets' in retriever.stats.counters:
+        raise Exception( "Unexpected ticket checks %s" % retriever.request.perm.calls )
+    print "ok"
+
+@test
+def shouldDropTheTicketsDeniedByAPolicy():
+    env = EnvironmentStub( default_data=True, enable=[ 'trac.*', DenyingPolicy ] )
+    env.config.set( 'trac', 'permission_policies',
+            'DenyingPolicy, DefaultPermissionPolicy, LegacyAttachmentPolicy' )
+    retriever = makeRetriever( env )
+    perm = retriever.request.perm
+    ids = [ t['id'] for t in retriever.filter_viewable_tickets( makeTickets() ) ]
+    if ids != [ 1, 3, 5 ]:
+        raise Exception( "Wrong viewable tickets %s" % ids )
+    if sorted( perm.calls ) != [ 1, 2, 3, 4, 5 ]:
+        raise Exception( "Expected one check per ticket, got %s" % perm.calls )
+    if retriever.stats.counters.get( 'hidden_tickets' ) != 2:
+        raise Exception( "Wrong hidden count %s" % retriever.stats.counters )
+
+    # The decisions are kept on the request.
+    perm.calls = []
+    again = Retriever( env, retriever.request )
+    ids = [ t['id'] for t in again.filter_viewable_tickets( makeTickets() ) ]
+    if ids != [ 1, 3, 5 ] or len(perm.calls) > 0:
+        raise Exception( "Expected the memoized decisions, got %s and checks %s" % ( ids, perm.calls ) )
+    if again.stats.counters.get( 'hidden_tickets' ) != 2:
+        raise Exception( "Wrong hidden count %s" % again.stats.counters )
+    print ids, "ok"
+
+runTests()
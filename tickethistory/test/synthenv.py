@@ -0,0 +1,88 @@
+from trac.test import EnvironmentStub
+from trac.util.datefmt import to_utimestamp, utc
+from datetime import datetime, timedelta
+import os
+import random
+
+# Generate a Trac environment with synthetic tickets and ticket changes.
+#
+# The tickets are created during the first part of the generated period and
+# then change their status, milestone and estimate.  The database is an
+# in-memory SQLite database unless a database file is set in the settings or
+# TRAC_TEST_DB_URI is set.
+
+STATES = [ "new", "assigned", "accepted", "testing", "closed" ]
+ESTIMATION_FIELD = "tm_estimate"
+
+
+class SyntheticEnvSettings:
+    def __init__(self, tickets=200, changesPerTicket=10, milestones=5, days=90,
+            start=datetime(2017, 1, 2, tzinfo=utc), seed=1, database=None):
+        self.tickets = tickets
+        self.changesPerTicket = changesPerTicket
+        self.milestones = milestones
+        self.days = days
+        self.start = start
+        self.seed = seed
+        self.database = database
+
+    def milestoneNames( self ):
+        return [ "sprint%d" % (i + 1) for i in xrange( self.milestones ) ]
+
+    def endTime( self ):
+        return self.start + timedelta( days=self.days )
+
+
+def createEnvironment( settings ):
+    if settings.database:
+        saved = os.environ.get( "TRAC_TEST_DB_URI" )
+        os.environ["TRAC_TEST_DB_URI"] = "sqlite:" + os.path.abspath( settings.database )
+        try:
+            env = EnvironmentStub( default_data=True )
+        finally:
+            if saved is None: del os.environ["TRAC_TEST_DB_URI"]
+            else: os.environ["TRAC_TEST_DB_URI"] = saved
+    else:
+        env = EnvironmentStub( default_data=True )
+    env.config.set( "ticket-custom", ESTIMATION_FIELD, "text" )
+    fillEnvironment( env, settings )
+    return env
+
+
+def fillEnvironment( env, settings ):
+    rnd = random.Random( settings.seed )
+    milestones = settings.milestoneNames()
+    seconds = settings.days * 86400
+    tickets = []
+    custom = []
+    changes = []
+    for tid in xrange( 1, settings.tickets + 1 ):
+        created = settings.start + timedelta( seconds=rnd.randint( 0, seconds / 2 ) )
+        state = { "status": "new", "milestone": rnd.choice( milestones ),
+                ESTIMATION_FIELD: str( rnd.randint( 0, 8 ) ) }
+        when = created
+        for i in xrange( rnd.randint( 0, 2 * settings.changesPerTicket ) ):
+            when += timedelta( seconds=rnd.randint( 60, max( 61, 2 * seconds / max( 1, settings.changesPerTicket ) ) ) )
+            field = rnd.choice( [ "status", "status", "milestone", ESTIMATION_FIELD, "comment" ] )
+            if field == "status": value = rnd.choice( STATES )
+            elif field == "milestone": value = rnd.choice( milestones )
+            elif field == ESTIMATION_FIELD: value = str( rnd.randint( 0, 8 ) )
+            else: value = "Comment %d" % i
+            old = state.get( field, "" )
+            state[field] = value
+            changes.append( ( tid, to_utimestamp( when ), "somebody", field, old, value ) )
+        tickets.append( ( tid, "task", to_utimestamp( created ), to_utimestamp( when ), "core", "major",
+            "somebody", "somebody", state["milestone"], state["status"], "Ticket %d" % tid ) )
+        custom.append( ( tid, ESTIMATION_FIELD, state[ESTIMATION_FIELD] ) )
+
+    with env.db_transaction as db:
+        cursor = db.cursor()
+        for name in milestones:
+            cursor.execute( "INSERT INTO milestone (name) VALUES (%s)", ( name, ) )
+        cursor.executemany( "INSERT INTO ticket (id, type, time, changetime, component, priority, "
+            "owner, reporter, milestone, status, summary) "
+            "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", tickets )
+        cursor.executemany( "INSERT INTO ticket_custom (ticket, name, value) VALUES (%s,%s,%s)", custom )
+        cursor.executemany( "INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) "
+            "VALUES (%s,%s,%s,%s,%s,%s)", changes )
+    return len( changes )
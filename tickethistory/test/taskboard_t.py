@@ -0,0 +1,129 @@
+from ..task_board import *
+from ..ticket_timetable import TimetableConfig, TicketInfo
+from .synthenv import *
+from trac.test import MockRequest
+from trac.ticket.model import Ticket
+from trac.web.api import RequestDone
+from datetime import datetime, timedelta
+import json
+import traceback
+
+tests=[]
+def test( fn ):
+    tests.append(fn)
+    return fn
+
+def runTests():
+    for t in tests:
+        print t
+        try: t()
+        except Exception as e:
+            print e
+            traceback.print_exc()
+        print
+
+def makeTickets( states ):
+    return [ TicketInfo( { 'id': i + 1 }, None, status, "m1" ) for i, status in enumerate( states ) ]
+
+@test
+def shouldSplitTicketsIntoDefaultColumns():
+    renderer = HtmlBoardRenderer( TimetableConfig() )
+    tickets = makeTickets( [ "new", "assigned", "closed", "testing", "new" ] )
+    columns = [ [ t.tid() for t in c ] for c in renderer.splitTicketsIntoColumns( tickets ) ]
+    if columns != [ [1, 5], [2, 4], [3] ]:
+        raise Exception( "Wrong columns %s" % columns )
+    print columns, "ok"
+
+@test
+def shouldSplitTicketsIntoCustomColumns():
+    columns = parseColumns( "New:new|Dev:assigned,accepted|Test:testing|Other:*|Done:closed" )
+    if [ c.title for c in columns ] != [ "New", "Dev", "Test", "Other", "Done" ]:
+        raise Exception( "Wrong titles" )
+    renderer = HtmlBoardRenderer( TimetableConfig(), columns )
+    tickets = makeTickets( [ "new", "accepted", "reopened", "testing", "assigned", "closed" ] )
+    columns = [ [ t.tid() for t in c ] for c in renderer.splitTicketsIntoColumns( tickets ) ]
+    if columns != [ [1], [2, 5], [4], [3], [6] ]:
+        raise Exception( "Wrong columns %s" % columns )
+    print columns, "ok"
+
+@test
+def shouldRejectInvalidColumns():
+    try:
+        parseColumns( "New|Done:closed" )
+    except TracError:
+        print "ok"
+        return
+    raise Exception( "Expected TracError" )
+
+def columnOptions( text ):
+    optionReg = TaskBoardOptions()
+    optionReg.set_macro_params( text )
+    optionReg.apply_defaults()
+    optionReg.verify()
+    return optionReg.options()
+
+@test
+def shouldParseTheColumnsOfTheMacroCall():
+    options = columnOptions( "milestone=m1,columns=New:new|Dev:assigned;accepted|Test:testing|Done:closed" )
+    columns = [ ( c.title, c.states ) for c in parseColumns( options['columns'] ) ]
+    if columns != [ ( "New", [ "new" ] ), ( "Dev", [ "assigned", "accepted" ] ),
+            ( "Test", [ "testing" ] ), ( "Done", [ "closed" ] ) ]:
+        raise Exception( "Wrong columns %s" % columns )
+    escaped = columnOptions( "milestone=m1,columns=New:new|Dev:assigned\\,accepted|Test:testing|Done:closed" )
+    if [ c.states for c in parseColumns( escaped['columns'] ) ][1] != [ "assigned", "accepted" ]:
+        raise Exception( "Wrong escaped columns %s" % escaped['columns'] )
+    try:
+        columnOptions( "milestone=m1,columns=New:new|Dev:assigned,accepted|Test:testing|Done:closed" )
+    except TracError as e:
+        print columns, e, "ok"
+        return
+    raise Exception( "Expected TracError for the unescaped comma" )
+
+
+def requestUpdates( env, since ):
+    args = { 'milestone': 'sprint1', 'columns': 'New:new|Dev:*|Done:closed', 'since': str( since ) }
+    req = MockRequest( env, path_info='/tickethistory/taskboard.json', args=args )
+    response = []
+    req.write = response.append
+    handler = TaskBoardUpdateHandler( env )
+    if not handler.match_request( req ):
+        raise Exception( "Request not matched" )
+    try: handler.process_request( req )
+    except RequestDone: pass
+    return json.loads( "".join( response ) )
+
+def changeTicket( env, milestone, field, value ):
+    tid = env.db_query( "SELECT MIN(id) FROM ticket WHERE milestone=%s AND status!='closed'", ( milestone, ) )[0][0]
+    ticket = Ticket( env, tid )
+    ticket[field] = value
+    ticket.save_changes( "somebody", "", datetime.now( utc ) - timedelta( seconds=1 ) )
+    return tid
+
+@test
+def shouldUpdateOnlyTheChangedBoardTickets():
+    env = createEnvironment( SyntheticEnvSettings( tickets=60, milestones=3 ) )
+    since = env.db_query( "SELECT MAX(changetime) FROM ticket" )[0][0]
+    data = requestUpdates( env, since )
+    if data != { 'since': since, 'tickets': [], 'removed': [] }:
+        raise Exception( "Unexpected update of an unchanged board %s" % data )
+
+    changeTicket( env, "sprint3", "status", "closed" )
+    data = requestUpdates( env, since )
+    if data != { 'since': since, 'tickets': [], 'removed': [] }:
+        raise Exception( "Unexpected update for a ticket in another milestone %s" % data )
+
+    closed = changeTicket( env, "sprint1", "status", "closed" )
+    moved = changeTicket( env, "sprint1", "milestone", "sprint2" )
+    data = requestUpdates( env, since )
+    notes = [ ( t['id'], t['column'] ) for t in data['tickets'] ]
+    if notes != [ ( closed, 2 ) ] or data['removed'] != [ moved ] or data['since'] <= since:
+        raise Exception( "Unexpected update %s %s" % ( notes, data['removed'] ) )
+    if 'data-ticket="%d"' % closed not in data['tickets'][0]['html']:
+        raise Exception( "Unexpected note %s" % data['tickets'][0]['html'] )
+
+    data = requestUpdates( env, data['since'] )
+    if len(data['tickets']) > 0 or len(data['removed']) > 0:
+        raise Exception( "Unexpected repeated update %s" % data )
+    print notes, moved, "ok"
+
+runTests()
@@ -6,3 +6,13 @@ cd ../..
 python -B -m tickethistory.test.workdays_t
 python -B -m tickethistory.test.distributor_t
 python -B -m tickethistory.test.iterations_t
+python -B -m tickethistory.test.timetable_t
+python -B -m tickethistory.test.taskboard_t
+python -B -m tickethistory.test.burndown_t
+python -B -m tickethistory.test.permissions_t
+
+# Benchmarks (not run by default):
+#   python -B -m tickethistory.test.timetable_bench
+#   python -B -m tickethistory.test.ticketinfo_bench
+#   python -B -m tickethistory.test.membership_bench
+#   python -B -m tickethistory.test.macro_bench --output results.json
@@ -0,0 +1,112 @@
+from ..ticket_timetable import *
+from datetime import datetime, timedelta
+import random
+import resource
+import subprocess
+import sys
+
+# Compare the peak RSS of a generated timetable that stores the fields of
+# every TicketInfo in a separate dictionary (legacy) with the timetable that
+# stores them in compact TicketInfo objects with interned values.
+#
+# Every mode runs in its own process:
+#   python -B -m tickethistory.test.ticketinfo_bench [days tickets]
+
+class _LegacyTicketInfo:
+    def __init__(self, ticket, time, status, milestone):
+        self.time = time
+        self.ticket = ticket
+        self.status = status
+        self.milestone = milestone
+        self.value = {}
+
+    def tid( self ):
+        return self.ticket['id']
+
+
+def _legacyGenerateTicketInfo( ticket, history, timetable ):
+    def addTicketToTimetableEntry( ticket, time, state, tt_entry ):
+        state = copy.copy( state )
+        ticket_info = _LegacyTicketInfo( ticket, time, state['status'], state['milestone'] )
+        del state['status']
+        del state['milestone']
+        ticket_info.value = state
+        tt_entry.tickets.append( ticket_info )
+
+    state = {}
+    prev_entry = None
+    for hist_time in sorted(history.keys()):
+        entry = timetable.getEntryForTime( hist_time )
+        if entry == None:
+            break
+        if entry != prev_entry:
+            if prev_entry is not None:
+                addTicketToTimetableEntry( ticket, hist_time, state, prev_entry )
+            prev_entry = entry
+        state.update( history[hist_time] )
+
+    if prev_entry != None:
+        addTicketToTimetableEntry( ticket, hist_time, state, prev_entry )
+
+
+# The values are created from strings on every change like the values read
+# from the database, so equal values are separate objects.
+def _value( text ):
+    return u"".join( list( text ) )
+
+
+def makeHistory( start, days, tid, rnd ):
+    ticket = { 'id': tid, 'time': start, 'summary': u"Ticket %d" % tid }
+    history = { start: { 'status': _value( 'new' ), 'milestone': _value( 'm1' ),
+            'component': _value( 'core' ), 'priority': _value( 'major' ),
+            'owner': _value( 'somebody' ), 'tm_estimate': _value( '3' ) } }
+    for d in xrange( days ):
+        when = start + timedelta( days=d, hours=rnd.randint( 1, 23 ) )
+        history[when] = { 'status': _value( rnd.choice( ['new', 'assigned', 'testing', 'closed'] ) ),
+                'tm_estimate': _value( str( rnd.randint( 0, 8 ) ) ) }
+    return ticket, history
+
+
+def buildTimetable( mode, days, ticketCount ):
+    start = datetime( 2017, 1, 2 )
+    timetable = Timetable( start )
+    timetable.entries = [ TimetableEntry( start + timedelta( days=d, hours=23, minutes=59 ) ) for d in xrange(days) ]
+    timetable.sort()
+    rnd = random.Random( 1 )
+    builder = HistoryBuilder( None, None )
+    schema = FieldSchema()
+    for tid in xrange( 1, ticketCount + 1 ):
+        ticket, history = makeHistory( start, days, tid, rnd )
+        if mode == "legacy":
+            _legacyGenerateTicketInfo( ticket, history, timetable )
+        else:
+            builder._generateTicketInfo( ticket, history, timetable, schema )
+    timetable._propagateTicketInfoForward()
+    return timetable
+
+
+def measure( mode, days, ticketCount ):
+    before = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    timetable = buildTimetable( mode, days, ticketCount )
+    peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    print "%s %d %d" % ( mode, before, peak )
+
+
+def runBenchmark( days, ticketCount ):
+    results = {}
+    for mode in [ "legacy", "compact" ]:
+        out = subprocess.check_output( [ sys.executable, "-B", "-m", "tickethistory.test.ticketinfo_bench",
+            "--measure", mode, str(days), str(ticketCount) ] )
+        _, before, peak = out.split()
+        results[mode] = int(peak) - int(before)
+        print "%-8s days %4d, tickets %5d: peak RSS growth %8d kB" % ( mode, days, ticketCount, results[mode] )
+    if results["compact"] > 0:
+        print "ratio %.2f" % ( float( results["legacy"] ) / results["compact"] )
+
+
+if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+    measure( sys.argv[2], int(sys.argv[3]), int(sys.argv[4]) )
+elif len(sys.argv) > 2:
+    runBenchmark( int(sys.argv[1]), int(sys.argv[2]) )
+else:
+    runBenchmark( 90, 1000 )
@@ -0,0 +1,93 @@
+from ..ticket_timetable import *
+from datetime import datetime, timedelta
+import random
+import time
+
+# Compare the placement of ticket history into timetable entries with a
+# linear search for every change against the bisect + merge-walk placement.
+
+def _linearEntryForTime( timetable, time ):
+    if time < timetable.startTime:
+        return timetable.entries[0]
+    if time > timetable.endTime:
+        return None
+    for t in timetable.entries:
+        if time <= t.endtime:
+            return t
+    return None
+
+def _linearGenerateTicketInfo( ticket, history, timetable, schema ):
+    def addTicketToTimetableEntry( ticket, time, state, tt_entry ):
+        state = copy.copy( state )
+        status = state.pop( 'status' )
+        milestone = state.pop( 'milestone' )
+        ticket_info = TicketInfo( ticket, time, status, milestone, schema, schema.pack( state ) )
+        tt_entry.tickets.append( ticket_info )
+
+    state = {}
+    prev_entry = None
+    for hist_time in sorted(history.keys()):
+        entry = _linearEntryForTime( timetable, hist_time )
+        if entry == None:
+            break
+        if entry != prev_entry:
+            if prev_entry is not None:
+                addTicketToTimetableEntry( ticket, hist_time, state, prev_entry )
+            prev_entry = entry
+        state.update( history[hist_time] )
+
+    if prev_entry != None:
+        addTicketToTimetableEntry( ticket, hist_time, state, prev_entry )
+
+def makeTimetable( start, days ):
+    timetable = Timetable( start )
+    timetable.entries = [ TimetableEntry( start + timedelta( days=d, hours=23 ) ) for d in xrange(days) ]
+    timetable.sort()
+    return timetable
+
+def makeHistories( start, days, ticketCount, changesPerTicket, seed=1 ):
+    rnd = random.Random( seed )
+    histories = []
+    for tid in xrange( 1, ticketCount + 1 ):
+        ticket = { 'id': tid, 'time': start }
+        history = { start: { 'status': 'new', 'milestone': 'm1' } }
+        for i in xrange( changesPerTicket ):
+            when = start + timedelta( minutes=rnd.randint( 0, days * 24 * 60 ) )
+            history[when] = { 'status': rnd.choice( ['new', 'assigned', 'closed'] ) }
+        histories.append( (ticket, history) )
+    return histories
+
+def timeIt( fn, repeat=3 ):
+    best = None
+    for i in xrange( repeat ):
+        started = time.time()
+        fn()
+        elapsed = time.time() - started
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+def runBenchmark( days, ticketCount, changesPerTicket ):
+    start = datetime( 2017, 1, 2 )
+    histories = makeHistories( start, days, ticketCount, changesPerTicket )
+    builder = HistoryBuilder( None, None )
+    schema = FieldSchema()
+
+    def linear():
+        timetable = makeTimetable( start, days )
+        for ticket, history in histories:
+            _linearGenerateTicketInfo( ticket, history, timetable, schema )
+
+    def mergeWalk():
+        timetable = makeTimetable( start, days )
+        for ticket, history in histories:
+            builder._generateTicketInfo( ticket, history, timetable, schema )
+
+    tlinear = timeIt( linear )
+    tmerge = timeIt( mergeWalk )
+    print "days %4d, tickets %5d, changes %6d: linear %.3fs, merge-walk %.3fs, speedup %.1fx" % (
+            days, ticketCount, ticketCount * changesPerTicket, tlinear, tmerge,
+            tlinear / tmerge if tmerge > 0 else 0 )
+
+runBenchmark( 14, 200, 10 )
+runBenchmark( 90, 1000, 10 )
+runBenchmark( 365, 1000, 20 )
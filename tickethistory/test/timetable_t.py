@@ -0,0 +1,191 @@
+from ..ticket_timetable import *
+from ..burn_down_series import BurnDownSeries, BurnDownAggregator, ABSENT, NEW, DONE
+from ..snapshots import TicketSnapshots, schema, SCHEMA_VERSION
+from .synthenv import *
+from trac.db.api import DatabaseManager
+from trac.ticket.model import Ticket
+from datetime import datetime, timedelta
+import traceback
+
+tests=[]
+def test( fn ):
+    tests.append(fn)
+    return fn
+
+def runTests():
+    for t in tests:
+        print t
+        try: t()
+        except Exception as e:
+            print e
+            traceback.print_exc()
+        print
+
+def _makeTimetable( start, days ):
+    timetable = Timetable( start )
+    timetable.entries = [ TimetableEntry( start + timedelta( days=d, hours=23 ) ) for d in xrange(days) ]
+    timetable.sort()
+    return timetable
+
+@test
+def shouldFindEntryForTime():
+    start = datetime( 2017, 3, 6 )
+    timetable = _makeTimetable( start, 5 )
+    def test( when, iexp ):
+        entry = timetable.getEntryForTime( when )
+        exp = timetable.entries[iexp] if iexp is not None else None
+        if entry is not exp:
+            raise Exception( "Wrong entry for %s, exp: %s" % (when, iexp) )
+        print when, iexp, "ok"
+
+    test( start - timedelta( days=10 ), 0 )
+    test( start, 0 )
+    test( start + timedelta( hours=23 ), 0 )
+    test( start + timedelta( hours=23, seconds=1 ), 1 )
+    test( start + timedelta( days=2, hours=12 ), 2 )
+    test( start + timedelta( days=4, hours=23 ), 4 )
+    test( start + timedelta( days=4, hours=23, seconds=1 ), None )
+
+@test
+def shouldPlaceHistoryIntoEntries():
+    start = datetime( 2017, 3, 6 )
+    timetable = _makeTimetable( start, 5 )
+    ticket = { 'id': 1, 'time': start }
+    history = {
+            start: { 'status': 'new', 'milestone': 'm1' },
+            start + timedelta( days=1, hours=2 ): { 'status': 'assigned' },
+            start + timedelta( days=1, hours=4 ): { 'status': 'testing' },
+            start + timedelta( days=3, hours=1 ): { 'status': 'closed' },
+            start + timedelta( days=9 ): { 'status': 'reopened' } }
+    HistoryBuilder( None, None )._generateTicketInfo( ticket, history, timetable )
+    statuses = [ [t.status for t in e.tickets] for e in timetable.entries ]
+    if statuses != [ ['new'], ['testing'], [], ['closed'], [] ]:
+        raise Exception( "Unexpected states %s" % statuses )
+    print statuses, "ok"
+
+@test
+def shouldStreamTheSameStatesAsTheFilledTimetable():
+    start = datetime( 2017, 3, 6 )
+    ticket = { 'id': 1, 'time': start + timedelta( hours=1 ), 'status': 'closed', 'milestone': 'm2' }
+    late = { 'id': 2, 'time': start + timedelta( days=2 ), 'status': 'new', 'milestone': 'm1' }
+    # ( ticket, field, time, oldvalue, newvalue ) ordered by time; time in hours
+    rows = [ ( 1, 'status', 26, 'new', 'assigned' ),
+            ( 1, 'status', 28, 'assigned', 'testing' ),
+            ( 1, 'milestone', 50, 'm1', 'm2' ),
+            ( 1, 'status', 73, 'testing', 'closed' ),
+            ( 1, 'status', 9 * 24, 'closed', 'reopened' ) ]
+    builder = HistoryBuilder( None, lambda t: t.milestone == 'm1' )
+    builder.timestamp_to_datetime = lambda ts: start + timedelta( hours=ts )
+    timetable = _makeTimetable( start, 5 )
+    initial = { 1: { 'status': 'new', 'milestone': 'm1' } }
+    entries = list( builder._streamEntries( [ticket, late], initial, rows, timetable,
+        set( ['status', 'milestone'] ) ) )
+    statuses = [ sorted( ( t.tid(), t.status ) for t in e.tickets ) for e in entries ]
+    expected = [ [(1, 'new')], [(1, 'testing')], [(2, 'new')], [(2, 'new')], [(2, 'new')] ]
+    if statuses != expected:
+        raise Exception( "Unexpected states %s" % statuses )
+    if [ e.endtime for e in entries ] != [ e.endtime for e in timetable.entries ]:
+        raise Exception( "Unexpected endtimes" )
+    if len(timetable.entries[0].tickets) > 0:
+        raise Exception( "The timetable was modified" )
+    print statuses, "ok"
+
+@test
+def shouldIterateTheSameDaysAsTheSeries():
+    start = datetime( 2017, 3, 6 )
+    config = TimetableConfig()
+    tickets = [ { 'id': i, 'time': start + timedelta( hours=i ), 'status': 'new', 'milestone': 'm1',
+        config.estimation_field: str( i ) } for i in xrange( 1, 5 ) ]
+    rows = [ ( i, 'status', 24 * i + 2, 'new', 'closed' ) for i in xrange( 1, 4 ) ]
+    builder = HistoryBuilder( None, lambda t: t.milestone == 'm1' )
+    builder.timestamp_to_datetime = lambda ts: start + timedelta( hours=ts )
+    def entries():
+        initial = dict( ( t['id'], { 'status': 'new', 'milestone': 'm1' } ) for t in tickets )
+        return builder._streamEntries( tickets, initial, rows, _makeTimetable( start, 10 ),
+                set( ['status', 'milestone'] ) )
+    end = start + timedelta( days=9, hours=23 )
+    series = BurnDownSeries.fromEntries( config, entries(), start, end )
+    days = list( BurnDownSeries.iterDays( config, entries(), start, end ) )
+    def values( day ):
+        return ( day.endtime, day.total, day.done, day.end, day.endWorkdays, day.delay )
+    if [ values( d ) for d in days ] != [ values( d ) for d in series.days ]:
+        raise Exception( "Unexpected days %s" % [ values( d ) for d in days ] )
+    print [ d.remaining for d in days ], "ok"
+
+@test
+def shouldAggregateTheSameSumsWithAndWithoutNumpy():
+    start = datetime( 2017, 3, 6 )
+    config = TimetableConfig()
+    tickets = [ TicketInfo( { 'id': i, config.estimation_field: str( i * 0.7 ) }, None,
+        'closed' if i % 3 == 0 else 'new', 'm1' ) for i in xrange( 1, 7 ) ]
+    entries = _makeTimetable( start, 4 ).entries
+    for day, entry in enumerate( entries ):
+        entry.tickets = tickets[day:]
+    def sums( days ):
+        return [ ( d.endtime, d.total, d.new, d.wip, d.done ) for d in days ]
+    expected = sums( BurnDownAggregator( config, useNumpy=False ).aggregate( entries ) )
+    streamed = sums( BurnDownAggregator( config ).iterate( iter( entries ) ) )
+    if streamed != expected:
+        raise Exception( "Unexpected streamed sums %s" % streamed )
+    aggregator = BurnDownAggregator( config )
+    if aggregator.useNumpy:
+        if sums( aggregator.aggregate( entries ) ) != expected:
+            raise Exception( "Unexpected NumPy sums %s" % sums( aggregator.aggregate( entries ) ) )
+        est, cat = aggregator.buildMatrices( entries )
+        if est.shape != ( 4, 6 ) or cat[3].tolist() != [ ABSENT ] * 3 + [ NEW, NEW, DONE ]:
+            raise Exception( "Unexpected matrices %s" % cat.tolist() )
+    print [ s[1] for s in expected ], aggregator.useNumpy, "ok"
+
+
+class RecordingWorkerPool:
+    parallel = True
+    workers = 4
+
+    def __init__( self ):
+        self.tasks = []
+
+    def map( self, func, items ):
+        self.tasks = list( items )
+        return [ func( item ) for item in self.tasks ]
+
+@test
+def shouldSplitTheHistoryBetweenTheWorkers():
+    builder = HistoryBuilder( None, None )
+    builder.workerPool = RecordingWorkerPool()
+    builder._loadChangeRows = lambda chunk, settings, since=None, byTime=False, until=None: [
+            ( tid, 'status', 1, 'new', 'closed' ) for tid in chunk ]
+    def chunkSizes( count ):
+        rows = list( builder._iterChangeRows( range( count ), None ) )
+        if [ r[0] for r in rows ] != range( count ):
+            raise Exception( "Unexpected rows for %d tickets" % count )
+        return [ len(chunk) for chunk in builder.workerPool.tasks ]
+    small, large = chunkSizes( 10 ), chunkSizes( 5000 )
+    if small != [ 3, 3, 3, 1 ] or large != [ builder.historyChunkSize ] * 10:
+        raise Exception( "Unexpected chunks %s %s" % ( small, large ) )
+    print small, "ok"
+
+@test
+def shouldStoreSnapshotsOnceAnotherProcessInstalledTheTable():
+    env = createEnvironment( SyntheticEnvSettings( tickets=5 ) )
+    snapshots = TicketSnapshots( env )
+    if snapshots.installed:
+        raise Exception( "Expected no snapshot table" )
+
+    # trac-admin creates the table in another process.
+    connector, _ = DatabaseManager( env ).get_connector()
+    with env.db_transaction as db:
+        for sql in connector.to_sql( schema[0] ):
+            db( sql )
+        db( "INSERT INTO system (name, value) VALUES (%s, %s)",
+                ( "tickethistory_snapshot_version", str( SCHEMA_VERSION ) ) )
+
+    ticket = Ticket( env )
+    ticket.populate( { 'summary': "New", 'status': "new", 'milestone': "sprint1", 'reporter': "somebody" } )
+    ticket.insert()
+    snapshots.ticket_created( ticket )
+    rows = env.db_query( "SELECT status, milestone FROM tickethistory_snapshot WHERE ticket=%s", ( ticket.id, ) )
+    if rows != [ ( "new", "sprint1" ) ]:
+        raise Exception( "Expected the snapshot of the new ticket, got %s" % rows )
+    print rows, "ok"
+
+runTests()
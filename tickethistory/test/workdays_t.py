@@ -49,38 +49,6 @@ def shouldEstimateEnd():
     test( "2017-03-06 00:00", "2017-03-10 00:00", 2, 1, "2017-03-14" )
     test( "2017-03-06 00:00", "2017-03-13 00:00", 2, 1, "2017-03-20" )
 
-@test
-def shouldAdjustStart():
-    def test( d1, dexp ):
-        dexp = _parse_datetime(dexp)
-        dres = adjusted_start( _parse_datetime( d1 ) )
-        print "expected: %s, actual %s, %s" % (dexp, dres, _is_same_dt( dres, dexp, 5 ) )
-
-    # Monday 2017-03-06
-    test( "2017-03-06 08:00", "2017-03-06 08:00" )
-    test( "2017-03-07 08:00", "2017-03-07 08:00" )
-    test( "2017-03-08 08:00", "2017-03-08 08:00" )
-    test( "2017-03-09 08:00", "2017-03-09 08:00" )
-    test( "2017-03-10 08:00", "2017-03-10 08:00" )
-    test( "2017-03-11 08:00", "2017-03-13 00:00" )
-    test( "2017-03-12 08:00", "2017-03-13 00:00" )
-
-@test
-def shouldAdjustEnd():
-    def test( d1, dexp ):
-        dexp = _parse_datetime(dexp)
-        dres = adjusted_end( _parse_datetime( d1 ) )
-        print "expected: %s, actual %s, %s" % (dexp, dres, _is_same_dt( dres, dexp, 5 ) )
-
-    # Monday 2017-03-06
-    test( "2017-03-06 08:00", "2017-03-06 08:00" )
-    test( "2017-03-07 08:00", "2017-03-07 08:00" )
-    test( "2017-03-08 08:00", "2017-03-08 08:00" )
-    test( "2017-03-09 08:00", "2017-03-09 08:00" )
-    test( "2017-03-10 08:00", "2017-03-10 08:00" )
-    test( "2017-03-11 08:00", "2017-03-10 23:59" )
-    test( "2017-03-12 08:00", "2017-03-10 23:59" )
-
 @test
 def shouldEstimateEndWorkdays():
     def test( d1, d2, total, remaining, dexp ):
@@ -126,4 +94,68 @@ def shouldEstimateEndWorkdays2():
         print done, dt.timedelta( weeks=done ),
         test( d1, d2, done+1, done, dexp )
 
+@test
+def shouldEstimateEndWorkdaysBatch():
+    def test( d1, d2s, total, remaining, dexps, weekmask=WEEKMASK, holidays=() ):
+        d1 = _parse_datetime(d1)
+        d2s = [ _parse_datetime(d2) for d2 in d2s ]
+        dexps = [ _parse_datetime(dexp) for dexp in dexps ]
+        for useNumpy in ( [True, False] if numpy is not None else [False] ):
+            calendar = busdays( weekmask, [ _parse_date( h ) for h in holidays ], useNumpy )
+            dress = estimate_end_workdays_batch( d1, d2s, [total] * len(d2s), [remaining] * len(d2s),
+                    calendar=calendar )
+            for dres, dexp in zip( dress, dexps ):
+                print "expected: %s, actual %s, %s" % (dexp, dres, _is_same_dt( dres, dexp, 3 ) )
+
+    # Monday 2017-03-06
+    test( "2017-03-06 08:00", [ "2017-03-07 08:00", "2017-03-08 08:00", "2017-03-09 08:00",
+        "2017-03-10 08:00", "2017-03-13 08:00" ], 2, 1,
+        [ "2017-03-08 08:00", "2017-03-10 08:00", "2017-03-14 08:00", "2017-03-16 08:00",
+            "2017-03-20 08:00" ] )
+    # Start and now on weekend
+    test( "2017-03-04 08:00", [ "2017-03-10 08:00", "2017-03-12 08:00" ], 2, 1,
+        [ "2017-03-16 08:00", "2017-03-17 23:59" ] )
+    # A holiday on Friday is skipped
+    test( "2017-03-06 08:00", [ "2017-03-09 08:00" ], 2, 1, [ "2017-03-15 08:00" ],
+            holidays=[ "2017-03-10" ] )
+    # A four-day week
+    test( "2017-03-06 08:00", [ "2017-03-08 08:00" ], 2, 1, [ "2017-03-13 08:00" ],
+            weekmask="1111000" )
+
+@test
+def shouldCountBusdaysWithoutNumpy():
+    holidays = [ _parse_date( "2017-04-14" ), _parse_date( "2017-04-17" ) ]
+    calendar = busdays( WEEKMASK, holidays, useNumpy=False )
+    def test( d1, d2, exp ):
+        res = calendar.count( _parse_date( d1 ), _parse_date( d2 ) )
+        print "expected: %s, actual %s, %s" % (exp, res, res == exp )
+
+    test( "2017-04-10", "2017-04-24", 8 )
+    test( "2017-04-24", "2017-04-10", -8 )
+    test( "2017-04-15", "2017-04-18", 0 )
+    test( "2017-04-03", "2017-05-01", 18 )
+
+@test
+def shouldLookUpWorkdaysInBusinessCalendar():
+    holidays = [ _parse_date( "2017-04-14" ), _parse_date( "2017-04-17" ) ]
+    first = _parse_date( "2017-04-01" )
+    last = _parse_date( "2017-05-31" )
+    reference = busdays( "1111100", holidays, useNumpy=False )
+    for useNumpy in ( [True, False] if numpy is not None else [False] ):
+        calendar = BusinessCalendar( "1111100", holidays, first, last, useNumpy )
+        mismatches = 0
+        for d1 in xrange( -10, 70, 3 ):
+            begin = first + dt.timedelta( days=d1 )
+            for d2 in xrange( -10, 70, 4 ):
+                end = first + dt.timedelta( days=d2 )
+                if calendar.count( begin, end ) != reference.count( begin, end ):
+                    mismatches += 1
+                if calendar.rollBackward( end ) != reference.rollBackward( end ):
+                    mismatches += 1
+            for n in xrange( -5, 50, 7 ):
+                if calendar.offset( begin, n ) != reference.offset( begin, n ):
+                    mismatches += 1
+        print "numpy: %s, mismatches: %d, %s" % ( useNumpy, mismatches, mismatches == 0 )
+    print "holiday is workday: %s, %s" % ( calendar.is_busday( holidays[0] ), not calendar.is_busday( holidays[0] ) )
+
 runTests()
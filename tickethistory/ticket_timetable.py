@@ -3,7 +3,10 @@
 ## Licensed under the MIT License. See LICENSE file in the project root for full license information.
 
 import copy
-import re
+import bisect
+import heapq
+
+from tickethistory import stage_stats
 
 class TimetableConfig:
     def __init__(self):
@@ -27,20 +30,79 @@ class TimetableConfig:
         self.getIsInIteration = getIsInIteration
 
 
-class TicketInfo:
-    def __init__(self, ticket, time, status, milestone):
+# Marks the fields that are not set in a TicketInfo.
+_MISSING = object()
+
+
+class FieldSchema(object):
+    """
+    The names of the fields that are stored in TicketInfo.values and a pool
+    of field values that are shared between the TicketInfo objects.  The
+    schema grows when a state with a new field name is packed.
+    """
+    __slots__ = ( 'names', 'index', '_pool' )
+
+    def __init__(self, names=()):
+        self.names = []
+        self.index = {}
+        self._pool = {}
+        for name in names:
+            self._addName( name )
+
+    def _addName( self, name ):
+        self.index[name] = len(self.names)
+        self.names.append( name )
+
+    def intern( self, value ):
+        if value is None:
+            return None
+        try: return self._pool.setdefault( value, value )
+        except TypeError: return value
+
+    # Convert the dictionary @p state to a tuple of interned values.
+    def pack( self, state ):
+        for name in state:
+            if name not in self.index:
+                self._addName( name )
+        values = [ _MISSING ] * len(self.names)
+        for name, value in state.iteritems():
+            values[self.index[name]] = self.intern( value )
+        return tuple( values )
+
+
+class TicketInfo(object):
+    __slots__ = ( 'time', 'ticket', 'status', 'milestone', 'schema', 'values' )
+
+    def __init__(self, ticket, time, status, milestone, schema=None, values=()):
         self.time = time
         self.ticket = ticket
         self.status = status
         self.milestone = milestone
-        self.value = {} # other fields
+        self.schema = schema # FieldSchema of the other fields
+        self.values = values # values of the other fields, indexed by schema
+
+    def _get( self, name ):
+        if self.schema is None:
+            return _MISSING
+        i = self.schema.index.get( name )
+        if i is None or i >= len(self.values):
+            return _MISSING
+        return self.values[i]
+
+    @property
+    def value( self ):
+        """A dictionary with the other fields."""
+        if self.schema is None:
+            return {}
+        return { name : v for name, v in zip( self.schema.names, self.values ) if v is not _MISSING }
 
     def tid( self ):
         return self.ticket['id'] if self.ticket is not None else None
 
     def value_or( self, name, default=None):
-        if name in self.value:
-            return self.value[name]
+        v = self._get( name )
+        if v is not _MISSING:
+            return v
         if name == "status":
             return self.status if self.status is not None else default
         if name == "milestone":
@@ -50,7 +112,8 @@ class TicketInfo:
         return default
 
     def __repr__(self):
-        return "(T %s, %s, %s, %s)" % ( self.tid(), self.status, self.time, len(self.value) )
+        return "(T %s, %s, %s, %s)" % ( self.tid(), self.status, self.time,
+                sum( 1 for v in self.values if v is not _MISSING ) )
 
 
 class TimetableEntry:
@@ -65,9 +128,11 @@ class Timetable:
         self.startTime = startTime
         self.endTime = None
         self.entries = []
+        self._endtimes = [] # sorted endtimes of the entries, updated in sort()
 
     def sort( self ):
         self.entries.sort(key=lambda e: e.endtime)
+        self._endtimes = [ e.endtime for e in self.entries ]
         times = [ e.endtime for e in self.entries if e.endtime is not None ]
         self.endTime = times[-1] if len(times) > 0 else None
         startTime = times[0] if len(times) > 0 else None
@@ -75,36 +140,96 @@ class Timetable:
             if self.startTime is None or startTime < self.startTime:
                 self.startTime = startTime
 
-    def getEntryForTime( self, time ):
+    # Find the index of the first entry that ends at or after @p time.
+    # Returns len(entries) if the time is after the end of the timetable.
+    def getEntryIndexForTime( self, time ):
+        if len(self._endtimes) != len(self.entries):
+            self.sort()
         if time < self.startTime:
-            return self.entries[0]
+            return 0
         if time > self.endTime:
-            return None
-        for t in self.entries:
-            if time <= t.endtime:
-                return t
-        return None
+            return len(self.entries)
+        return bisect.bisect_left( self._endtimes, time )
+
+    def getEntryForTime( self, time ):
+        ientry = self.getEntryIndexForTime( time )
+        return self.entries[ientry] if ientry < len(self.entries) else None
 
 
+    # Carry the state of the tickets forward: every entry receives the latest
+    # TicketInfo of every ticket seen in this or in the previous entries.
+    # The TicketInfo objects are shared between the entries and must not be
+    # modified afterwards.
     def _propagateTicketInfoForward( self ):
-        prev_entry = None
+        current = {} # tid -> the latest TicketInfo
         for entry in self.entries:
-            if prev_entry is not None:
-                prev_tickets = { t.tid() : t for t in prev_entry.tickets }
-                curr_tickets = { t.tid() : t for t in entry.tickets }
-                for tid,t in prev_tickets.items():
-                    if tid not in curr_tickets:
-                        entry.tickets.append( copy.copy( t ) )
-            prev_entry = entry
+            for t in entry.tickets:
+                current[t.tid()] = t
+            entry.tickets = current.values()
 
 
     def _removeTicketsIfNotInIteration( self, isInIteration=lambda ticketInfo: True ):
+        # A shared TicketInfo is tested only once.
+        inIteration = {}
+        def test( t ):
+            key = id( t )
+            if key not in inIteration:
+                inIteration[key] = isInIteration( t )
+            return inIteration[key]
+
         for entry in self.entries:
-            entry.tickets = [ t for t in entry.tickets if isInIteration( t ) ]
+            entry.tickets = [ t for t in entry.tickets if test( t ) ]
+
+
+
+def _chunks( items, size ):
+    for i in xrange( 0, len(items), size ):
+        yield items[i:i+size]
+
+def _placeholders( count ):
+    return ", ".join( ["%s"] * count )
 
+# The shared HistoryBuilder._HistorySettings: frozenset( fields ) -> settings
+_historySettings = {}
+
+
+class _TicketHistoryCollector:
+    """
+    Build the history of a single ticket from its change rows.  The rows must
+    be added in chronological order.
+    """
+    def __init__(self, ticket, fields, timestamp_to_datetime):
+        self.ticket = ticket
+        self.fields = fields
+        self.timestamp_to_datetime = timestamp_to_datetime
+        self.creation_time = ticket['time']
+        self.earliest = { f : None for f in fields }
+        # for every change register the new state { field:value }
+        self.history = { self.creation_time : { f : None for f in fields } }
+
+    def addChange( self, row_field, row_time, row_old, row_new ):
+        event_time = self.timestamp_to_datetime(row_time)
+        if not event_time in self.history:
+            self.history[event_time] = {}
+        self.history[event_time][row_field] = row_new
+        if self.earliest[row_field] is None:
+            self.earliest[row_field] = row_old
+
+    def finish( self ):
+        t = self.ticket
+        creation_state = self.history[self.creation_time]
+        # project missing values into creation_time
+        for f in self.fields:
+            if f not in creation_state or creation_state[f] is None:
+                earliest = self.earliest[f]
+                creation_state[f] = earliest if earliest is not None else t.get(f)
+        return self.history
 
 
 class HistoryBuilder:
+    # The maximum number of ticket ids in a single history query.
+    historyChunkSize = 500
+
     def __init__(self, env, isInIteration ):
         self.env = env
         self.isInIteration = isInIteration if isInIteration is not None else lambda ticketInfo: True
@@ -113,6 +238,25 @@ class HistoryBuilder:
 
         self.timestamp_to_datetime = lambda tstamp: invalid( "timestamp_to_datetime not set" )
 
+        # The inverse of timestamp_to_datetime.  If it is set, only the
+        # changes within the time window of the timetable are retrieved from
+        # the database.
+        self.datetime_to_timestamp = None
+
+        # An optional TicketHistoryCache that keeps the change rows between requests.
+        self.historyCache = None
+
+        # An optional HistoryWorkerPool that retrieves the chunks of change
+        # rows in parallel.
+        self.workerPool = None
+
+        # An optional TicketSnapshots store with the daily states of the
+        # tickets.  Used by iterTimetableEntries if it covers the fields.
+        self.snapshotStore = None
+
+        # The StageStats of the macro that uses the builder.
+        self.stats = stage_stats.StageStats()
+
 
     # @p tickets - a list of dictionaries as returned by trac.ticket.query.Query.execute
     # @p timetable - Timetable with a list of TimetableEntry instances
@@ -126,80 +270,382 @@ class HistoryBuilder:
         fields.add( 'milestone' )
         fields.add( 'status' )
         fields.discard( 'id' )
-        historySettings = self._HistorySettings( fields )
+        historySettings = self._getHistorySettings( fields )
+        schema = FieldSchema( sorted( fields - set( ['status', 'milestone'] ) ) )
 
-        for t in tickets:
-            history = self._collectTicketHistory( t, historySettings )
-            self._generateTicketInfo( t, history, timetable )
+        with self.stats.stage( "changes" ):
+            histories = self._collectTicketHistories( tickets, historySettings, self._timeWindow( timetable, tickets, fields ) )
+        with self.stats.stage( "propagation" ):
+            for t in tickets:
+                self._generateTicketInfo( t, histories[t['id']], timetable, schema )
 
-        timetable._propagateTicketInfoForward()
-        timetable._removeTicketsIfNotInIteration( self.isInIteration )
+            timetable._propagateTicketInfoForward()
+            timetable._removeTicketsIfNotInIteration( self.isInIteration )
+        self.stats.count( "entries", len(timetable.entries) )
 
 
     class _HistorySettings:
+        """
+        The history statements for a set of fields.  The field names and the
+        ticket ids are bound parameters, so the text of a statement depends
+        only on the number of the ids and the fields.  The statements are
+        built once per shape and shared; see _getHistorySettings.
+        """
         def __init__(self, fields):
-            self.fields = fields
-            self.ticket_query_sql = None
-
-            rxvalidfiled = re.compile( '^[A-Za-z0-9._]+$' )
-            sql_field_list = ", ".join( ["'%s'" % f for f in fields if rxvalidfiled.match(f) is not None] )
-            self.ticket_query_sql = ( "SELECT "
-                    "DISTINCT c.field as field, c.time AS time, c.oldvalue as oldvalue, c.newvalue as newvalue "
-                    "FROM ticket t, ticket_change c "
-                    "WHERE t.id = %%s and c.ticket = t.id and (c.field in (%s))"
-                    "ORDER BY c.time ASC" % ( sql_field_list ) )
-
+            self.fields = frozenset( fields )
+            self.fieldArgs = sorted( self.fields )
+            self._statements = {}
+
+        def _statement( self, key, build ):
+            sql = self._statements.get( key )
+            if sql is None:
+                sql = build()
+                self._statements[key] = sql
+            return sql
+
+        # Return the statement and the arguments that retrieve the change
+        # rows of the tickets in @p chunk, newer than @p since and not newer
+        # than @p until if they are set.  The rows of a ticket must be in
+        # chronological order, so the statement always has an ORDER BY
+        # clause.
+        def historyQuery( self, chunk, since=None, byTime=False, until=None ):
+            withSince = since is not None
+            withUntil = until is not None
+            def build():
+                return ( "SELECT "
+                    "c.ticket AS ticket, c.field AS field, c.time AS time, "
+                    "c.oldvalue AS oldvalue, c.newvalue AS newvalue "
+                    "FROM ticket_change c "
+                    "WHERE c.ticket IN (%s) AND c.field IN (%s)%s%s "
+                    "ORDER BY %s" % ( _placeholders( len(chunk) ), _placeholders( len(self.fieldArgs) ),
+                        " AND c.time > %s" if withSince else "",
+                        " AND c.time <= %s" if withUntil else "",
+                        "c.time ASC, c.ticket ASC" if byTime else "c.ticket ASC, c.time ASC" ) )
+            sql = self._statement( ( "history", len(chunk), withSince, byTime, withUntil ), build )
+            args = list( chunk ) + self.fieldArgs
+            if withSince:
+                args.append( since )
+            if withUntil:
+                args.append( until )
+            return sql, args
+
+        # Return the statement and the arguments that retrieve the first
+        # non-empty oldvalue of every field: the value that the field had
+        # when the ticket was created.  If @p since is set, only the changes
+        # after @p since are considered; the oldvalue is then the value that
+        # the field had at the time @p since.
+        def initialStateQuery( self, chunk, since=None ):
+            withSince = since is not None
+            def build():
+                return ( "SELECT c.ticket, c.field, c.oldvalue "
+                    "FROM ticket_change c "
+                    "WHERE c.ticket IN (%s) AND c.field IN (%s) AND c.oldvalue IS NOT NULL%s "
+                    "AND c.time = (SELECT MIN(p.time) FROM ticket_change p "
+                    "WHERE p.ticket = c.ticket AND p.field = c.field AND p.oldvalue IS NOT NULL%s)"
+                    "" % ( _placeholders( len(chunk) ), _placeholders( len(self.fieldArgs) ),
+                        " AND c.time > %s" if withSince else "",
+                        " AND p.time > %s" if withSince else "" ) )
+            sql = self._statement( ( "initial", len(chunk), withSince ), build )
+            args = list( chunk ) + self.fieldArgs
+            if withSince:
+                args += [ since, since ]
+            return sql, args
+
+
+    # Return the shared _HistorySettings for the set of @p fields.
+    @staticmethod
+    def _getHistorySettings( fields ):
+        key = frozenset( fields )
+        settings = _historySettings.get( key )
+        if settings is None:
+            settings = HistoryBuilder._HistorySettings( key )
+            _historySettings[key] = settings
+        return settings
+
+
+    # Return the time window ( start, end ) of the @p timetable as timestamps,
+    # or None if the changes are not limited by time.  The state of a ticket
+    # at the start of the window is taken from the first change after the
+    # start or from the current values, so all the @p fields must be present
+    # in the @p tickets.
+    def _timeWindow( self, timetable, tickets, fields ):
+        if self.datetime_to_timestamp is None or timetable.startTime is None or timetable.endTime is None:
+            return None
+        if not all( f in t for t in tickets for f in fields ):
+            return None
+        return ( self.datetime_to_timestamp( timetable.startTime ),
+                self.datetime_to_timestamp( timetable.endTime ) )
+
+
+    # Retrieve the change rows (ticket, field, time, oldvalue, newvalue) for
+    # the tickets with @p ticketIds.  The rows are ordered by ticket and time.
+    # If @p since is set, only the rows with a later timestamp are retrieved;
+    # if @p until is set, only the rows up to that timestamp.
+    def _iterChangeRows( self, ticketIds, historySettings, since=None, until=None ):
+        ids = sorted( set( ticketIds ) )
+        if self.workerPool is not None and self.workerPool.parallel:
+            chunks = self._parallelChunks( ids )
+            self.stats.count( "queries", len(chunks) )
+            for rows in self.workerPool.map(
+                    lambda chunk: self._loadChangeRows( chunk, historySettings, since, until=until ), chunks ):
+                for row in rows:
+                    yield row
+            return
 
-    # Collect history for a single ticket.
-    def _collectTicketHistory( self, ticket, historySettings ):
-        t = ticket
-        creation_time = t['time']
-        settings = historySettings
-        fields = settings.fields
+        with self.env.db_query as database:
+            cursor = database.cursor()
+            for chunk in _chunks( ids, self.historyChunkSize ):
+                self.stats.count( "queries" )
+                cursor.execute( *historySettings.historyQuery( chunk, since, until=until ) )
+                for row in cursor:
+                    yield row
+
+
+    # Split the sorted ticket @p ids into one chunk per worker of the worker
+    # pool, so that the small milestones are retrieved in parallel too.  The
+    # chunks are not larger than historyChunkSize.
+    def _parallelChunks( self, ids ):
+        workers = max( 1, self.workerPool.workers )
+        size = min( self.historyChunkSize, max( 1, ( len(ids) + workers - 1 ) / workers ) )
+        return list( _chunks( ids, size ) )
+
+
+    # Retrieve the change rows of a single chunk of ticket ids.  Runs in a
+    # worker thread with its own database connection.
+    def _loadChangeRows( self, chunk, historySettings, since=None, byTime=False, until=None ):
+        with self.env.db_query as database:
+            cursor = database.cursor()
+            cursor.execute( *historySettings.historyQuery( chunk, since, byTime, until ) )
+            return cursor.fetchall()
+
+
+    # Retrieve the change rows like _iterChangeRows but ordered by time.  The
+    # rows of the chunks are merged while they are read.  In parallel mode
+    # the chunks are retrieved completely before they are merged.
+    def _iterChangeRowsByTime( self, ticketIds, historySettings, since=None, until=None ):
+        ids = sorted( set( ticketIds ) )
+        if self.workerPool is not None and self.workerPool.parallel:
+            chunks = self._parallelChunks( ids )
+            self.stats.count( "queries", len(chunks) )
+            chunkRows = self.workerPool.map(
+                    lambda chunk: self._loadChangeRows( chunk, historySettings, since, True, until ), chunks )
+            sources = [ [ ( ( row[2], row[0] ), row ) for row in rows ] for rows in chunkRows ]
+            for _, row in heapq.merge( *sources ):
+                yield row
+            return
 
         with self.env.db_query as database:
-            history_cursor = database.cursor()
-            history_cursor.execute( settings.ticket_query_sql, [t['id']]  )
-
-            earliest = { f : None for f in fields }
-            latest = { f : t.get(f) for f in fields }
-            # for every change register the new state { field:value }
-            history = { creation_time : { f : None for f in fields } }
-
-            # collect history for the ticket
-            for row in history_cursor:
-                row_field, row_time, row_old, row_new = row
-                event_time = self.timestamp_to_datetime(row_time)
-                if not event_time in history:
-                    history[event_time] = {}
-                history[event_time][row_field] = row_new
-                if earliest[row_field] is None:
-                    earliest[row_field] = row_old
-
-            # project missing values into creation_time
+            def chunkRows( chunk ):
+                cursor = database.cursor()
+                self.stats.count( "queries" )
+                cursor.execute( *historySettings.historyQuery( chunk, since, True, until ) )
+                for row in cursor:
+                    yield ( row[2], row[0] ), row
+            sources = [ chunkRows( chunk ) for chunk in _chunks( ids, self.historyChunkSize ) ]
+            for _, row in heapq.merge( *sources ):
+                yield row
+
+
+    # Retrieve the values of the fields at the creation of the tickets with
+    # @p ticketIds, or at the time @p since for the tickets created earlier.
+    # Returns { ticket_id : { field : value } } with the fields that were
+    # changed later.
+    def _loadInitialStates( self, ticketIds, historySettings, since=None ):
+        states = {}
+        with self.env.db_query as database:
+            cursor = database.cursor()
+            for chunk in _chunks( sorted( set( ticketIds ) ), self.historyChunkSize ):
+                self.stats.count( "queries" )
+                cursor.execute( *historySettings.initialStateQuery( chunk, since ) )
+                for tid, field, oldvalue in cursor:
+                    states.setdefault( tid, {} )[field] = oldvalue
+        return states
+
+
+    # Return the initial states and the time ordered change rows of the
+    # @p tickets from the history cache.  The cache keeps the rows in memory
+    # anyway so they can be sorted.
+    def _cachedChangesByTime( self, tickets, historySettings ):
+        states = {}
+        rows = []
+        for row in self.historyCache.iterChangeRows( tickets, historySettings, self._iterChangeRows ):
+            if row[3] is not None:
+                states.setdefault( row[0], {} ).setdefault( row[1], row[3] )
+            rows.append( row )
+        rows.sort( key=lambda row: ( row[2], row[0] ) )
+        return states, rows
+
+
+    # Generate the timetable entries in streaming mode.  The ticket states
+    # are advanced through the time ordered change rows and every entry is
+    # yielded as soon as all the changes up to its endtime are applied.
+    # When the snapshot store is used, the endtimes of the entries must be
+    # at the end of the days.
+    # Only the current state of every ticket is kept, so the entries of
+    # @p timetable are not modified: new TimetableEntry objects are yielded
+    # and the caller decides whether to keep them.  The TicketInfo objects
+    # of the unchanged tickets are shared between the consecutive entries.
+    # The tickets that are not in the iteration are left out.
+    def iterTimetableEntries( self, tickets, timetable, fieldNames ):
+        if len(timetable.entries) == 0:
+            return
+        timetable.sort()
+        fields = set( fieldNames )
+        fields.add( 'milestone' )
+        fields.add( 'status' )
+        fields.discard( 'id' )
+        historySettings = self._getHistorySettings( fields )
+        ids = [ t['id'] for t in tickets ]
+        with self.stats.stage( "changes" ):
+            if len(ids) == 0:
+                rows = []
+                initialStates = {}
+            elif self.snapshotStore is not None and self.snapshotStore.covers( fields ):
+                # The snapshots hold the complete state at the end of a day, the
+                # first one on the day the ticket was created.
+                initialStates = {}
+                self.stats.count( "queries", ( len(set( ids )) + self.historyChunkSize - 1 ) / self.historyChunkSize )
+                rows = self.snapshotStore.iterChangeRows( ids, timetable.endTime )
+            elif self.historyCache is not None:
+                initialStates, rows = self._cachedChangesByTime( tickets, historySettings )
+            else:
+                # The tickets created before the window start in the state
+                # they had at its start.
+                since, until = self._timeWindow( timetable, tickets, fields ) or ( None, None )
+                initialStates = self._loadInitialStates( ids, historySettings, since )
+                rows = self._iterChangeRowsByTime( ids, historySettings, since, until )
+
+        rows = self.stats.iterate( "changes", rows )
+        for entry in self._streamEntries( tickets, initialStates, rows, timetable, fields ):
+            yield entry
+
+
+    # Advance the ticket states through the time ordered change @p rows
+    # (ticket, field, time, oldvalue, newvalue) and yield a TimetableEntry for
+    # every endtime of the @p timetable.  The tickets join when they are
+    # created with the @p initialStates { ticket_id : { field : value } }.
+    def _streamEntries( self, tickets, initialStates, rows, timetable, fields ):
+        schema = FieldSchema( sorted( fields - set( ['status', 'milestone'] ) ) )
+        byCreation = iter( sorted( tickets, key=lambda t: t['time'] ) )
+        nextTicket = next( byCreation, None )
+        rows = iter( rows )
+        nextRow = next( rows, None )
+        nextRowTime = self.timestamp_to_datetime( nextRow[2] ) if nextRow is not None else None
+        ticketsById = { t['id'] : t for t in tickets }
+
+        states = {} # tid -> ( time, { field : value } )
+        current = {} # tid -> ( TicketInfo, isInIteration ) of the tickets in states
+        changed = set()
+
+        def createState( ticket ):
+            initial = initialStates.get( ticket['id'], {} )
+            state = {}
             for f in fields:
-                if f not in history[creation_time] or history[creation_time][f] is None:
-                    history[creation_time][f] = earliest[f] if earliest[f] is not None else latest[f]
+                v = initial.get( f )
+                state[f] = v if v is not None else ticket.get( f )
+            states[ticket['id']] = ( ticket['time'], state )
+            changed.add( ticket['id'] )
+
+        for endtime in timetable._endtimes:
+            while nextTicket is not None and nextTicket['time'] <= endtime:
+                if nextTicket['id'] not in states:
+                    createState( nextTicket )
+                nextTicket = next( byCreation, None )
+
+            rowCount = 0
+            while nextRow is not None and nextRowTime <= endtime:
+                rowCount += 1
+                tid = nextRow[0]
+                if tid not in states:
+                    createState( ticketsById[tid] )
+                states[tid][1][nextRow[1]] = nextRow[4]
+                states[tid] = ( nextRowTime, states[tid][1] )
+                changed.add( tid )
+                nextRow = next( rows, None )
+                nextRowTime = self.timestamp_to_datetime( nextRow[2] ) if nextRow is not None else None
+
+            for tid in changed:
+                time, state = states[tid]
+                values = dict( state )
+                status = schema.intern( values.pop( 'status' ) )
+                milestone = schema.intern( values.pop( 'milestone' ) )
+                ticket_info = TicketInfo( ticketsById[tid], time, status, milestone, schema, schema.pack( values ) )
+                current[tid] = ( ticket_info, self.isInIteration( ticket_info ) )
+            self.stats.count( "rows", rowCount )
+            self.stats.count( "ticket_infos", len(changed) )
+            self.stats.count( "entries" )
+            changed.clear()
+
+            entry = TimetableEntry( endtime )
+            entry.tickets = [ t for t, inIteration in current.itervalues() if inIteration ]
+            yield entry
+
+
+    # Collect history for all the tickets with a few batched queries.
+    # Returns a dictionary { ticket_id : history }.
+    # If the time @p window ( start, end ) is set and the history cache is
+    # not used, only the changes within the window are retrieved and the
+    # tickets created before the start begin with their state at the start.
+    def _collectTicketHistories( self, tickets, historySettings, window=None ):
+        collectors = {}
+        for t in tickets:
+            collectors[t['id']] = _TicketHistoryCollector( t, historySettings.fields,
+                    self.timestamp_to_datetime )
+
+        if self.historyCache is not None:
+            rows = self.historyCache.iterChangeRows( tickets, historySettings, self._iterChangeRows )
+        elif window is not None:
+            since, until = window
+            for tid, state in self._loadInitialStates( collectors.keys(), historySettings, since ).iteritems():
+                collectors[tid].earliest.update( state )
+            rows = self._iterChangeRows( collectors.keys(), historySettings, since, until )
+        else:
+            rows = self._iterChangeRows( collectors.keys(), historySettings )
+        rowCount = 0
+        for row in rows:
+            rowCount += 1
+            collectors[row[0]].addChange( *row[1:] )
+        self.stats.count( "rows", rowCount )
+
+        return { tid : c.finish() for tid, c in collectors.iteritems() }
 
-            return history
+
+    # Collect history for a single ticket.
+    def _collectTicketHistory( self, ticket, historySettings ):
+        return self._collectTicketHistories( [ticket], historySettings )[ticket['id']]
 
 
     # Add history entries for a single ticket to the timetable.
-    def _generateTicketInfo( self, ticket, history, timetable ):
+    # The values of the fields are stored in TicketInfo according to @p schema.
+    def _generateTicketInfo( self, ticket, history, timetable, schema=None ):
+        if schema is None:
+            schema = FieldSchema()
+
         def addTicketToTimetableEntry( ticket, time, state, tt_entry ):
             state = copy.copy( state ) # clone
-            ticket_info = TicketInfo( ticket, time, state['status'], state['milestone'] )
-            del state['status']
-            del state['milestone']
-            ticket_info.value = state;
+            status = schema.intern( state.pop( 'status' ) )
+            milestone = schema.intern( state.pop( 'milestone' ) )
+            ticket_info = TicketInfo( ticket, time, status, milestone, schema, schema.pack( state ) )
             tt_entry.tickets.append( ticket_info )
+            self.stats.count( "ticket_infos" )
+
+        # Both the history and the entries are sorted by time so we walk
+        # through them in parallel.
+        hist_times = sorted(history.keys())
+        if len(hist_times) == 0:
+            return
+        entries = timetable.entries
+        endtimes = timetable._endtimes
+        ientry = timetable.getEntryIndexForTime( hist_times[0] )
 
         state = {}
         prev_entry = None
-        for hist_time in sorted(history.keys()):
-            entry = timetable.getEntryForTime(hist_time)
-            if entry == None:
+        for hist_time in hist_times:
+            while ientry < len(entries) and endtimes[ientry] < hist_time:
+                ientry += 1
+            if ientry >= len(entries):
                 break
+            entry = entries[ientry]
             if entry != prev_entry:
                 if prev_entry is not None:
                     addTicketToTimetableEntry( ticket, hist_time, state, prev_entry )
@@ -2,9 +2,15 @@
 ## Copyright (c) 2017 Marko Mahnič. All rights reserved.
 ## Licensed under the MIT License. See LICENSE file in the project root for full license information.
 
+import bisect
 import math
 import datetime as dt
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def estimate_end( start, now, total, remaining ):
     done = total - remaining
     if done <= 0:
@@ -18,57 +24,273 @@ def estimate_end( start, now, total, remaining ):
     return now + dt.timedelta( hours = morehours )
 
 
-def _workday_diff( start, end ):
-    if start > end:
-        return 0
-    diff = end-start
-    if diff.days < 1:
-        return diff.seconds / 86400.0
+# Estimate the end of the work at the time @p now from the progress made
+# since @p start.  The workdays are defined by the BusinessCalendar
+# @p calendar; the default calendar has the workdays from Monday to Friday.
+def estimate_end_workdays( start, now, total, remaining, calendar=None ):
+    return estimate_end_workdays_batch( start, [now], [total], [remaining], calendar=calendar )[0]
 
-    daydiff = end.weekday() - start.weekday()
-    days = (diff.days - daydiff) / 7 * 5 + min(daydiff,5) - (max(end.weekday() - 4, 0) % 5)
-    return days + diff.seconds / 86400.0
 
+# Batch variants of the workday functions.
+#
+# The days on which the work is done are defined by a weekmask and a list of
+# holidays.  The weekmask is a string of seven characters '1' (workday) or
+# '0' (day off) for the days from Monday to Sunday.  NumPy busday functions
+# are used when NumPy is available.
 
-def skip_weekend( when ):
-    if when.weekday() <= 4:
-        return when
-    when += dt.timedelta( days = 2 - when.weekday() % 5 )
-    return when.replace( hour=0, minute=0, second=0, microsecond=0 )
+WEEKMASK = "1111100"
 
 
-def adjusted_start( when ):
-    return skip_weekend( when )
+class _PyBusdays:
+    """
+    Business day arithmetic with the semantics of numpy.busday_count and
+    numpy.busday_offset(roll='forward') for a single date.
+    """
+    def __init__(self, weekmask, holidays):
+        self.mask = [ c == '1' for c in weekmask ]
+        self.perWeek = sum( self.mask )
+        if len(self.mask) != 7 or self.perWeek == 0:
+            raise ValueError( "Invalid weekmask '%s'" % weekmask )
+        self.holidays = sorted( set( h for h in holidays if self.mask[h.weekday()] ) )
 
+    def is_busday( self, date ):
+        if not self.mask[date.weekday()]:
+            return False
+        i = bisect.bisect_left( self.holidays, date )
+        return i >= len(self.holidays) or self.holidays[i] != date
 
-def adjusted_end( when ):
-    if when.weekday() <= 4:
-        return when
-    when -= dt.timedelta( days = when.weekday() % 4 )
-    return when.replace( hour=23, minute=59, second=59, microsecond=0 )
+    # The number of business days in [begin, end).
+    def count( self, begin, end ):
+        if end < begin:
+            return -self.count( end, begin )
+        weeks, rest = divmod( (end - begin).days, 7 )
+        weekday = begin.weekday()
+        n = weeks * self.perWeek + sum( 1 for i in xrange( rest ) if self.mask[(weekday + i) % 7] )
+        return n - ( bisect.bisect_left( self.holidays, end ) - bisect.bisect_left( self.holidays, begin ) )
 
+    # Move @p date forward to a business day and then by @p n business days.
+    def offset( self, date, n ):
+        one = dt.timedelta( days=1 )
+        while not self.is_busday( date ):
+            date += one
+        week = dt.timedelta( days=7 )
+        while n > self.perWeek:
+            inWeek = self.count( date + one, date + one + week )
+            if inWeek > n:
+                break
+            date += week
+            n -= inWeek
+        while n > 0:
+            date += one
+            if self.is_busday( date ):
+                n -= 1
+        while n < 0:
+            date -= one
+            if self.is_busday( date ):
+                n += 1
+        return date
+
+    # Move @p date back to a business day.
+    def rollBackward( self, date ):
+        one = dt.timedelta( days=1 )
+        while not self.is_busday( date ):
+            date -= one
+        return date
+
+    def is_busday_batch( self, dates ):
+        return [ self.is_busday( d ) for d in dates ]
+
+    # The workday flags of the @p count dates starting with @p first.
+    def is_busday_range( self, first, count ):
+        return [ self.is_busday( first + dt.timedelta( days=i ) ) for i in xrange( count ) ]
+
+    def count_batch( self, begin, ends ):
+        return [ self.count( begin, e ) for e in ends ]
+
+    def offset_batch( self, dates, offsets ):
+        return [ self.offset( d, n ) for d, n in zip( dates, offsets ) ]
+
+    def rollBackward_batch( self, dates ):
+        return [ self.rollBackward( d ) for d in dates ]
+
+
+class _NumpyBusdays:
+    def __init__(self, weekmask, holidays):
+        self.calendar = numpy.busdaycalendar( weekmask=weekmask,
+                holidays=numpy.array( sorted( holidays ), dtype='datetime64[D]' ) )
+
+    @staticmethod
+    def _dates( dates ):
+        return numpy.array( dates, dtype='datetime64[D]' )
+
+    def is_busday( self, date ):
+        return bool( numpy.is_busday( self._dates( [date] ), busdaycal=self.calendar )[0] )
+
+    def count( self, begin, end ):
+        return int( numpy.busday_count( begin, end, busdaycal=self.calendar ) )
+
+    def is_busday_batch( self, dates ):
+        return numpy.is_busday( self._dates( dates ), busdaycal=self.calendar ).tolist()
+
+    def is_busday_range( self, first, count ):
+        start = numpy.datetime64( first, 'D' )
+        return numpy.is_busday( numpy.arange( start, start + count ), busdaycal=self.calendar ).tolist()
+
+    def count_batch( self, begin, ends ):
+        return numpy.busday_count( numpy.datetime64( begin, 'D' ), self._dates( ends ),
+                busdaycal=self.calendar ).tolist()
+
+    def offset_batch( self, dates, offsets ):
+        return numpy.busday_offset( self._dates( dates ), numpy.array( offsets, dtype=numpy.int64 ),
+                roll='forward', busdaycal=self.calendar ).tolist()
+
+    def rollBackward_batch( self, dates ):
+        return numpy.busday_offset( self._dates( dates ), 0, roll='backward',
+                busdaycal=self.calendar ).tolist()
+
+
+class BusinessCalendar:
+    """
+    The workdays defined by a weekmask and a list of holidays with a
+    precomputed index for the dates from @p first to @p last.
+
+    The index holds the cumulative number of workdays for every date in the
+    range and the position of every workday, so that the workday differences
+    and offsets within the range are array lookups.  The index and the dates
+    outside of the range are calculated with the busdays() implementation,
+    with the NumPy busday functions when NumPy is available.
+    """
+    def __init__(self, weekmask=WEEKMASK, holidays=(), first=None, last=None, useNumpy=None):
+        self.busdays = busdays( weekmask, holidays, useNumpy )
+        if first is None:
+            first = dt.date.today() - dt.timedelta( days=365 )
+        if last is None:
+            last = first + dt.timedelta( days=3 * 365 )
+        self.first = first
+        self.size = max( 0, ( last - first ).days + 1 )
+        # _cumulative[i] is the number of workdays in [first, first + i)
+        # and _workdays[k] is the position of the k-th workday in the range.
+        self._busday = self.busdays.is_busday_range( first, self.size )
+        self._cumulative = [ 0 ]
+        self._workdays = []
+        for i, work in enumerate( self._busday ):
+            if work:
+                self._workdays.append( i )
+            self._cumulative.append( len(self._workdays) )
+
+    def _index( self, date ):
+        i = ( date - self.first ).days
+        return i if 0 <= i < self.size else None
+
+    def is_busday( self, date ):
+        i = self._index( date )
+        return self._busday[i] if i is not None else self.busdays.is_busday( date )
+
+    def count( self, begin, end ):
+        ib = self._index( begin )
+        ie = self._index( end )
+        if ib is None or ie is None:
+            return self.busdays.count( begin, end )
+        return self._cumulative[ie] - self._cumulative[ib]
+
+    def offset( self, date, n ):
+        i = self._index( date )
+        if i is not None:
+            # The number of the workday on or after date plus n.
+            target = self._cumulative[i] + n
+            if 0 <= target < len(self._workdays):
+                return self.first + dt.timedelta( days=self._workdays[target] )
+        return self.busdays.offset_batch( [date], [n] )[0]
+
+    def rollBackward( self, date ):
+        i = self._index( date )
+        if i is not None and self._cumulative[i + 1] > 0:
+            return self.first + dt.timedelta( days=self._workdays[self._cumulative[i + 1] - 1] )
+        return self.busdays.rollBackward_batch( [date] )[0]
+
+    def is_busday_batch( self, dates ):
+        return [ self.is_busday( d ) for d in dates ]
+
+    def count_batch( self, begin, ends ):
+        return [ self.count( begin, e ) for e in ends ]
+
+    def offset_batch( self, dates, offsets ):
+        return [ self.offset( d, n ) for d, n in zip( dates, offsets ) ]
+
+    def rollBackward_batch( self, dates ):
+        return [ self.rollBackward( d ) for d in dates ]
+
+
+def busdays( weekmask=WEEKMASK, holidays=(), useNumpy=None ):
+    if useNumpy is None:
+        useNumpy = numpy is not None
+    if useNumpy and numpy is not None:
+        return _NumpyBusdays( weekmask, holidays )
+    return _PyBusdays( weekmask, holidays )
+
+
+def _day_fraction( when ):
+    return ( when.hour * 3600 + when.minute * 60 + when.second + when.microsecond / 1e6 ) / 86400.0
+
+
+# A BusinessCalendar for the forecasts made at the times @p nows.
+def _defaultCalendar( start, nows, weekmask, holidays ):
+    last = max( [ start ] + nows ).date() + dt.timedelta( days=366 )
+    return BusinessCalendar( weekmask, holidays, start.date() - dt.timedelta( days=7 ), last )
+
+
+# The number of workdays between @p start and every time in @p nows.  A time
+# on a day off is moved to the start of the next workday (@p start) or to
+# the end of the previous workday (@p nows).
+def workday_diff_batch( start, nows, weekmask=WEEKMASK, holidays=(), calendar=None ):
+    nows = list( nows )
+    if calendar is None:
+        calendar = _defaultCalendar( start, nows, weekmask, holidays )
+    startDate = start.date()
+    startFrac = _day_fraction( start )
+    if not calendar.is_busday( startDate ):
+        startDate = calendar.offset_batch( [startDate], [0] )[0]
+        startFrac = 0.0
+    nowDates = [ n.date() for n in nows ]
+    endDates = calendar.rollBackward_batch( nowDates )
+    endFracs = [ _day_fraction( n ) if e == d else 86399 / 86400.0
+            for n, d, e in zip( nows, nowDates, endDates ) ]
+    counts = calendar.count_batch( startDate, endDates )
+    return [ max( 0, c + f - startFrac ) for c, f in zip( counts, endFracs ) ]
 
-def estimate_end_workdays( start, now, total, remaining ):
-    done = total - remaining
-    if done <= 0:
-        return None
-    days = _workday_diff(adjusted_start(start), adjusted_end(now))
-    if days <= 0:
-        return None
 
-    perday = float(done) / days
-    moredays = remaining / perday
+# Estimate the end of the work for every time in @p nows from the progress
+# made since @p start.  The workdays are counted with the @p weekmask and
+# the @p holidays.  Returns a list with None for the times when no progress
+# was made.
+def estimate_end_workdays_batch( start, nows, totals, remainings, weekmask=WEEKMASK, holidays=(),
+        calendar=None ):
+    nows = list( nows )
+    if calendar is None:
+        calendar = _defaultCalendar( start, nows, weekmask, holidays )
+    elapsed = workday_diff_batch( start, nows, calendar=calendar )
 
-    # skip weekends
-    # Note: days may be 1 off because of rounding, but we are ok with that
-    ( weeks, days ) = divmod(int(moredays), 5 )
-    moredays += weeks * 2
-    nowStart = adjusted_start( now )
-    if nowStart.weekday() + days > 4:
-        moredays += 2
+    results = [ None ] * len(nows)
+    valid = [ i for i in xrange( len(nows) )
+            if totals[i] - remainings[i] > 0 and elapsed[i] > 0 ]
+    if len(valid) == 0:
+        return results
 
-    (seconds, moredays) = math.modf( moredays )
-    seconds *= 86400.0
-    enddate = nowStart + dt.timedelta( days = moredays, seconds = seconds )
-    return enddate
+    # The projection starts at the current time or at the start of the next
+    # workday.
+    nowDates = [ nows[i].date() for i in valid ]
+    startDates = calendar.offset_batch( nowDates, [0] * len(valid) )
+    offsets = []
+    fractions = []
+    for i, nowDate, startDate in zip( valid, nowDates, startDates ):
+        perday = float( totals[i] - remainings[i] ) / elapsed[i]
+        days = remainings[i] / perday + ( _day_fraction( nows[i] ) if startDate == nowDate else 0.0 )
+        whole = math.floor( days )
+        offsets.append( int( whole ) )
+        fractions.append( days - whole )
 
+    endDates = calendar.offset_batch( startDates, offsets )
+    for i, nowDate, endDate, fraction in zip( valid, nowDates, endDates, fractions ):
+        midnight = nows[i].replace( hour=0, minute=0, second=0, microsecond=0 )
+        results[i] = midnight + dt.timedelta( days=( endDate - nowDate ).days, seconds=fraction * 86400.0 )
+    return results
@@ -0,0 +1,62 @@
+## vim: set fileencoding=utf-8 sw=4 sts=4 ts=8 et :vim
+## Copyright (c) 2017 Marko Mahnič. All rights reserved.
+## Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from trac.core import Component
+from trac.config import IntOption
+from trac.db.api import DatabaseManager
+
+
+class HistoryWorkerPool(Component):
+    """
+    A bounded pool of threads that run the history queries in parallel.
+
+    Every worker thread gets its own connection from the Trac connection
+    pool.  The pool is used only when `history_workers` is greater than 1
+    and the database is not SQLite; otherwise the work is done serially in
+    the calling thread.
+    """
+
+    workers = IntOption('tickethistory', 'history_workers', 0,
+            """The number of threads that retrieve the ticket history in
+            parallel.  Useful for PostgreSQL and MySQL on large milestones.
+            Set to 0 or 1 to retrieve the history serially.  Ignored for
+            SQLite.""")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._poolSize = 0
+
+
+    @property
+    def parallel( self ):
+        return self.workers > 1 and not self._isSqlite()
+
+
+    def _isSqlite( self ):
+        return DatabaseManager(self.env).connection_uri.startswith( 'sqlite:' )
+
+
+    def _getPool( self ):
+        with self._lock:
+            if self._pool is None or self._poolSize != self.workers:
+                if self._pool is not None:
+                    self._pool.close()
+                self._pool = ThreadPool( self.workers )
+                self._poolSize = self.workers
+            return self._pool
+
+
+    # Return [ func( item ) for item in items ].  The items are processed in
+    # parallel if the pool is enabled.  The first exception raised by func
+    # is re-raised in the calling thread.
+    def map( self, func, items ):
+        items = list( items )
+        if len(items) < 2 or not self.parallel:
+            return [ func( item ) for item in items ]
+        self.log.debug( "HistoryWorkerPool: %d tasks, %d workers", len(items), self.workers )
+        return self._getPool().map( func, items )